@@ -0,0 +1,201 @@
+# This file contains the tANS (table-based asymmetric numeral systems) backend of the data part, in the style of FSE,
+# an alternative to the huffman code words and elias run lengths of RunLengthEncoder.encode_data
+# The characters of the runs and the buckets of their lengths are coded with two models, each a table of normalized counts
+# that add up to the table size. A run length in bucket b is 2 ** (b - 1) plus b - 1 extra bits written as they are
+# Every run is coded by two states, one per model: the decoder looks both states up in its tables, reads the bits of both
+# states and the extra bits of the length in one read, and gets the character, the run length and the next two states
+# ANS decodes in the reverse order of encoding, so the encoder codes the runs from the last one and writes the bits of the
+# runs in reverse order after the first states of the decoder
+#
+# Data part layout (after the start of the header from encode_flags, FLAG_ANS):
+#   character model: table log (4 bits), number of characters, then (character, normalized count) of each
+#   length model: table log (4 bits), number of buckets, then (bucket - 1 in 6 bits, normalized count) of each
+#   first character state, first length state, each table log bits
+#   for every run: bits of the character state, bits of the length state, extra bits of the run length
+# numbers are elias encoded
+
+import heapq
+import numpy as np
+
+# smallest and largest table log, the table log of a model grows with the number of runs between them
+MIN_TABLE_LOG = 5
+MAX_TABLE_LOG = 11
+TABLE_LOG_BITS = 4
+# bits of a bucket in the length model, run lengths below 2 ** 64
+BUCKET_BITS = 6
+
+# Table log of a model of the given number of symbols coding the given number of runs
+def table_log(runs, symbols):
+    log = max(min(MAX_TABLE_LOG, runs.bit_length() - 2), MIN_TABLE_LOG)
+    # every symbol needs at least one state
+    return max(log, (symbols - 1).bit_length())
+
+# Scale the counts of the symbols to normalized counts that add up to 2 ** table_log, every symbol with a count keeps one
+# the counts are rounded down first and the states left over are given, or taken back, one at a time where it costs least
+def normalize(counts, table_log):
+    size = 1 << table_log
+    counts = {symbol: count for symbol, count in counts.items() if count > 0}
+    total = sum(counts.values())
+    norm = {symbol: max(count * size // total, 1) for symbol, count in counts.items()}
+    diff = size - sum(norm.values())
+    # a state more saves count * log2((norm + 1) / norm) bits, a state less costs count * log2(norm / (norm - 1)) bits
+    if diff > 0:
+        heap = [(-count * np.log2((norm[symbol] + 1) / norm[symbol]), symbol) for symbol, count in counts.items()]
+        heapq.heapify(heap)
+        for _ in range(diff):
+            _, symbol = heapq.heappop(heap)
+            norm[symbol] += 1
+            heapq.heappush(heap, (-counts[symbol] * np.log2((norm[symbol] + 1) / norm[symbol]), symbol))
+    elif diff < 0:
+        heap = [(count * np.log2(norm[symbol] / (norm[symbol] - 1)), symbol)
+                for symbol, count in counts.items() if norm[symbol] > 1]
+        heapq.heapify(heap)
+        for _ in range(-diff):
+            _, symbol = heapq.heappop(heap)
+            norm[symbol] -= 1
+            if norm[symbol] > 1:
+                heapq.heappush(heap, (counts[symbol] * np.log2(norm[symbol] / (norm[symbol] - 1)), symbol))
+    return norm
+
+# Normalized counts and table log of the model of the array of symbols
+def build_model(symbols):
+    counts = np.bincount(symbols)
+    log = table_log(len(symbols), int(np.count_nonzero(counts)))
+    return normalize(dict(enumerate(counts.tolist())), log), log
+
+# Symbol of every state, the states of a symbol are spread over the table with the step of FSE
+def spread(norm, table_log):
+    size = 1 << table_log
+    step = (size >> 1) + (size >> 3) + 3
+    symbols = [None] * size
+    pos = 0
+    for symbol in sorted(norm):
+        for _ in range(norm[symbol]):
+            symbols[pos] = symbol
+            pos = (pos + step) & (size - 1)
+    return symbols
+
+# Encoding table of the model, maps every symbol to (most bits written, state from which that many bits are written,
+# the states its coded state leads to), the encoder state x runs from 2 ** table_log to 2 ** (table_log + 1)
+def encoding_table(norm, table_log):
+    size = 1 << table_log
+    table = {symbol: [] for symbol in norm}
+    for state, symbol in enumerate(spread(norm, table_log)):
+        table[symbol].append(size + state)
+    for symbol, count in norm.items():
+        # x >> bits must fall in [count, 2 * count)
+        bits = table_log + 1 - count.bit_length()
+        table[symbol] = (bits, count << bits, [None] * count + table[symbol])
+    return table
+
+# Decoding table of the model, maps every state to (symbol, number of bits to read, base of the next state)
+def decoding_table(norm, table_log):
+    size = 1 << table_log
+    next_state = dict(norm)
+    table = []
+    for symbol in spread(norm, table_log):
+        x = next_state[symbol]
+        next_state[symbol] += 1
+        bits = table_log + 1 - x.bit_length()
+        table.append((symbol, bits, (x << bits) - size))
+    return table
+
+# Bucket of every run length, its number of bits
+def length_buckets(run_lengths):
+    return np.frexp(run_lengths.astype(np.float64))[1].astype(np.int64)
+
+# Write the table log and the normalized counts of a model
+def write_model(writer, norm, table_log, symbol_bits, offset=0):
+    writer.write(table_log, TABLE_LOG_BITS)
+    writer.write_elias(len(norm))
+    for symbol in sorted(norm):
+        writer.write(symbol - offset, symbol_bits)
+        writer.write_elias(norm[symbol])
+
+# Read the table log and the normalized counts of a model
+def read_model(reader, symbol_bits, offset=0):
+    log = reader.read(TABLE_LOG_BITS)
+    norm = {}
+    for _ in range(reader.read_elias()):
+        symbol = reader.read(symbol_bits) + offset
+        norm[symbol] = reader.read_elias()
+    if sum(norm.values()) != 1 << log:
+        raise ValueError("normalized counts do not add up to the table size")
+    return norm, log
+
+# Code the runs of the BWT after the start of the header in the BitWriter, char_bits is the number of bits of a character
+def encode_runs(writer, run_chars, run_lengths, char_bits):
+    buckets = length_buckets(run_lengths)
+    char_norm, char_log = build_model(run_chars)
+    bucket_norm, bucket_log = build_model(buckets)
+    write_model(writer, char_norm, char_log, char_bits)
+    write_model(writer, bucket_norm, bucket_log, BUCKET_BITS, 1)
+
+    char_table = encoding_table(char_norm, char_log)
+    bucket_table = encoding_table(bucket_norm, bucket_log)
+    # the extra bits of every run length, below its bucket bit
+    extras = (run_lengths - (1 << (buckets - 1))).tolist()
+    char_state = 1 << char_log
+    bucket_state = 1 << bucket_log
+    values = []
+    lengths = []
+    for char, bucket, extra in zip(reversed(run_chars.tolist()), reversed(buckets.tolist()), reversed(extras)):
+        char_bits_out, threshold, states = char_table[char]
+        if char_state < threshold:
+            char_bits_out -= 1
+        value = char_state & ((1 << char_bits_out) - 1)
+        char_state = states[char_state >> char_bits_out]
+        bucket_bits_out, threshold, states = bucket_table[bucket]
+        if bucket_state < threshold:
+            bucket_bits_out -= 1
+        value = (value << bucket_bits_out) | (bucket_state & ((1 << bucket_bits_out) - 1))
+        bucket_state = states[bucket_state >> bucket_bits_out]
+        values.append((value << (bucket - 1)) | extra)
+        lengths.append(char_bits_out + bucket_bits_out + bucket - 1)
+
+    writer.write(char_state - (1 << char_log), char_log)
+    writer.write(bucket_state - (1 << bucket_log), bucket_log)
+    write = writer.write
+    for value, length in zip(reversed(values), reversed(lengths)):
+        write(value, length)
+    return writer
+
+# Decode the runs from the BitReader up to decoded_length characters, returns the string of the BWT
+# the bits are read through a local accumulator refilled 64 bits at a time, which keeps the loop free of method calls
+def decode_runs(reader, decoded_length, char_bits):
+    char_norm, char_log = read_model(reader, char_bits)
+    bucket_norm, bucket_log = read_model(reader, BUCKET_BITS, 1)
+    # the entries hold everything the loop needs, the masks of the bits included:
+    # (character, bits, mask, base) and (bits, mask, base, first run length, extra bits, mask of the extra bits)
+    char_table = [(chr(char), bits, (1 << bits) - 1, base) for char, bits, base in decoding_table(char_norm, char_log)]
+    bucket_table = [(bits, (1 << bits) - 1, base, 1 << (bucket - 1), bucket - 1, (1 << (bucket - 1)) - 1)
+                    for bucket, bits, base in decoding_table(bucket_norm, bucket_log)]
+    char_state = reader.read(char_log)
+    bucket_state = reader.read(bucket_log)
+
+    # bytes from the one of the position on, padded so a refill never runs past the end, and the bits of the first byte left
+    start = reader.pos >> 3
+    data = bytes(reader.data[start:]) + bytes(8)
+    offset = 1
+    available = 8 - (reader.pos & 7)
+    acc = data[0] & ((1 << available) - 1)
+    decoded_data = []
+    decoded = 0
+    while decoded < decoded_length:
+        char, char_bits_in, char_mask, char_base = char_table[char_state]
+        bucket_bits_in, bucket_mask, bucket_base, run_length, extra_bits, extra_mask = bucket_table[bucket_state]
+        count = char_bits_in + bucket_bits_in + extra_bits
+        if available < count:
+            acc = ((acc & ((1 << available) - 1)) << 64) | int.from_bytes(data[offset:offset + 8], 'big')
+            offset += 8
+            available += 64
+        available -= count
+        value = acc >> available
+        run_length += value & extra_mask
+        value >>= extra_bits
+        bucket_state = bucket_base + (value & bucket_mask)
+        char_state = char_base + ((value >> bucket_bits_in) & char_mask)
+        decoded_data.append(char * run_length)
+        decoded += run_length
+    reader.seek(((start + offset) << 3) - available)
+    return ''.join(decoded_data)
@@ -1,41 +1,303 @@
-from flask import Flask, request, render_template, send_file, redirect, url_for
-from encoder import RunLengthEncoder
+from flask import Flask, Response, jsonify, request, render_template
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+from blocks import (DEDUP_MAGIC, DEFAULT_BLOCK_SIZE, MAGIC, compress_stream, decode_frame, decompress_stream, dedup_items,
+                    encode_item, fit_blocks, is_container, read_frames, read_magic, resolve_references, write_frames)
+from cache import ResultCache, cache_key
+from encoder import RunLengthEncoder, estimate_memory
 from decoder import RunLengthDecoder
+from dictionary import load_directory
+from instrument import Metrics, add_hook, collect, stage
+from jobs import DONE, JobQueue
+import io
 import os
+import threading
 
 app = Flask(__name__)
 
+# number of processes doing the encoding and decoding, uploads are handled on threads and wait for them
+WORKERS = int(os.environ.get('WORKERS', os.cpu_count() or 1))
+# most uploads being encoded or decoded at once, including the ones waiting for a process, later uploads get 503
+MAX_PENDING = int(os.environ.get('MAX_PENDING', 4 * WORKERS))
+# size of the chunks the result is streamed back in
+CHUNK_SIZE = 64 * 1024
+
+# results of repeated uploads are served from the cache, CACHE_DIR adds an on-disk tier bounded by CACHE_DISK_BYTES
+cache = ResultCache(int(os.environ.get('CACHE_BYTES', 64 << 20)), os.environ.get('CACHE_DIR'),
+                    int(os.environ.get('CACHE_DISK_BYTES', 1 << 30)))
+
+# pick the pipeline of every upload from a sample of it, so incompressible uploads are stored instead, ADAPTIVE=0 turns it off
+ADAPTIVE = os.environ.get('ADAPTIVE', '1') != '0'
+
+# memory budget in bytes of every worker process, uploads too large to encode in one piece within it are encoded as a
+# block container whose blocks fit, so a worker is slower on them instead of running out of memory. 0 means no budget
+MAX_MEMORY = int(os.environ.get('MAX_MEMORY', 0)) or None
+
+# uploads encoded as block containers write repeated chunks as references to their first copy, DEDUP=0 turns it off
+DEDUP = os.environ.get('DEDUP', '1') != '0'
+
+# pretrained huffman dictionaries, every .bwtd file in DICTIONARY_DIR is loaded so uploads coded with them can be decoded,
+# and DICTIONARY is the id of the one uploads are encoded with, files it fits poorly still get a table of their own
+if os.environ.get('DICTIONARY_DIR'):
+    load_directory(os.environ['DICTIONARY_DIR'])
+DICTIONARY = int(os.environ['DICTIONARY']) if os.environ.get('DICTIONARY') else None
+
+# entropy backend of the runs, 'huffman' or the tANS backend 'ans', which cannot be combined with DICTIONARY
+ENTROPY = os.environ.get('ENTROPY', 'huffman')
+
+# stage figures served by /metrics, METRICS=0 turns the instrumentation off and METRICS_MEMORY=1 also traces allocation peaks
+METRICS = os.environ.get('METRICS', '1') != '0'
+METRICS_MEMORY = os.environ.get('METRICS_MEMORY', '0') == '1'
+metrics = Metrics()
+if METRICS:
+    add_hook(metrics)
+# most jobs queued or running at once, later ones get 503, and seconds a finished job and its result are kept
+MAX_JOBS = int(os.environ.get('MAX_JOBS', 4 * WORKERS))
+JOB_TTL = int(os.environ.get('JOB_TTL', 3600))
+# jobs larger than one block are coded block by block on the pool, so their progress is reported as the blocks finish
+JOB_BLOCK_SIZE = int(os.environ.get('JOB_BLOCK_SIZE', DEFAULT_BLOCK_SIZE))
+
+# uploads turned away because every slot was taken, and uploads that failed to encode or decode
+# counted under the lock of the stage metrics, as requests are served on several threads
+rejected = {'busy': 0, 'invalid': 0}
+
+# Count an upload turned away for the reason, 'busy' or 'invalid'
+def reject(reason):
+    with metrics.lock:
+        rejected[reason] += 1
+
+# the pool is only started by the first upload, so importing the app (or a worker process) does not start one
+executor = None
+executor_lock = threading.Lock()
+pending = threading.BoundedSemaphore(MAX_PENDING)
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ProcessPoolExecutor(WORKERS)
+        return executor
+
+# jobs run on the same worker pool as the uploads
+jobs = JobQueue(get_executor, WORKERS, MAX_JOBS, JOB_TTL)
+
+# characters the text mode of the encoder accepts before the '$' terminator, anything else is encoded as binary data
+TEXT_CHARS = frozenset(range(37, 127))
+
+# Encode the uploaded bytes in memory, returns the encoded bytes
+# text keeps the original behaviour of adding the '$' terminator, other files are encoded as bytes
+# uploads over the memory budget are encoded as binary blocks, which decode to exactly the uploaded bytes
+def encode_upload(data):
+    if MAX_MEMORY is not None and estimate_memory(len(data) + 1) > MAX_MEMORY:
+        return b''.join(compress_stream(io.BytesIO(data), adaptive=ADAPTIVE, max_memory=MAX_MEMORY, dictionary=DICTIONARY,
+                                        entropy=ENTROPY, dedup=DEDUP))
+    # the terminator may only end the text, it is added when missing
+    if data and TEXT_CHARS.issuperset(data[:-1] if data.endswith(b'$') else data):
+        string = data.decode('ascii')
+        if string[-1] != '$':
+            string += '$'
+        return RunLengthEncoder(string, output_file=None, adaptive=ADAPTIVE, max_memory=MAX_MEMORY, dictionary=DICTIONARY,
+                                entropy=ENTROPY).to_bytes()
+    return RunLengthEncoder(data, output_file=None, adaptive=ADAPTIVE, max_memory=MAX_MEMORY, dictionary=DICTIONARY,
+                            entropy=ENTROPY).to_bytes()
+
+# Decode the uploaded bytes in memory, returns the decoded bytes, block containers are recognised by their magic number
+def decode_upload(data):
+    if is_container(data):
+        return b''.join(decompress_stream(io.BytesIO(data)))
+    original_data = RunLengthDecoder(data, output_file=None).original_data
+    if isinstance(original_data, str):
+        original_data = original_data.encode('ascii')
+    return original_data
+
+# Call func in a worker process and collect the events of its stages, returns (result, events)
+def instrumented(func, data, memory):
+    with collect(memory) as events:
+        result = func(data)
+    return result, events
+
+# Settings the result of the action depends on, they are part of its cache key so a result cached under other settings,
+# e.g. in the disk tier before a restart, is never served. Decoding gives the same result whatever the settings
+def cache_options(action):
+    if action == 'decode' or action == 'job.decode':
+        return {}
+    options = {'adaptive': ADAPTIVE, 'max_memory': MAX_MEMORY, 'dictionary': DICTIONARY, 'entropy': ENTROPY, 'dedup': DEDUP}
+    if action == 'job.encode':
+        options['job_block_size'] = JOB_BLOCK_SIZE
+    return options
+
+# Run func on the worker pool and wait for its result, returns None when too many uploads are already pending
+# the result is looked up in the cache first, and stored in it once computed
+def run_job(func, data, action):
+    key = cache_key(data, action, **cache_options(action))
+    result = cache.get(key)
+    if result is not None:
+        return result
+    if not pending.acquire(blocking=False):
+        return None
+    try:
+        if METRICS:
+            result, events = get_executor().submit(instrumented, func, data, METRICS_MEMORY).result()
+            for event in events:
+                metrics.record(event)
+        else:
+            result = get_executor().submit(func, data).result()
+    finally:
+        pending.release()
+    cache.put(key, result)
+    return result
+
+# Map func over the items of the job on the worker pool and yield the results in order, collecting the events of
+# their stages like run_job
+def job_map(job, func, items):
+    if not METRICS:
+        yield from jobs.map(job, func, items)
+        return
+    for result, events in jobs.map(job, partial(instrumented, func, memory=METRICS_MEMORY), items):
+        for event in events:
+            metrics.record(event)
+        yield result
+
+# Encode an upload as a job, uploads larger than a block are encoded as a container of binary blocks
+def encode_job(job, data):
+    block_size = JOB_BLOCK_SIZE if MAX_MEMORY is None else fit_blocks(JOB_BLOCK_SIZE, 1, MAX_MEMORY)[0]
+    if len(data) <= block_size:
+        return list(job_map(job, encode_upload, [data]))[0]
+    blocks = [data[start:start + block_size] for start in range(0, len(data), block_size)]
+    if DEDUP:
+        blocks = list(dedup_items(blocks, block_size, 0))
+    frames = job_map(job, partial(encode_item, adaptive=ADAPTIVE, max_memory=MAX_MEMORY, dictionary=DICTIONARY, entropy=ENTROPY),
+                     blocks)
+    magic = DEDUP_MAGIC if DEDUP else MAGIC
+    return b''.join(chain([magic], write_frames(frames, True, True, [], 0, len(magic))))
+
+# Decode an upload as a job, the blocks of a block container are decoded one by one
+def decode_job(job, data):
+    if not is_container(data):
+        return list(job_map(job, decode_upload, [data]))[0]
+    container = io.BytesIO(data)
+    window = read_magic(container)
+    blocks = resolve_references(job_map(job, decode_frame, read_frames(container)), window)
+    return b''.join(block.encode('ascii') if isinstance(block, str) else block for block in blocks)
+
+JOB_WORK = {'encode': encode_job, 'decode': decode_job}
+
+# Work of every job, the result is looked up in the cache first, and stored in it once computed
+def cached_job(job, data):
+    action = 'job.' + job.action
+    return cache.get_or_compute(data, action, lambda: JOB_WORK[job.action](job, data), **cache_options(action))
+
+# Stream the bytes back as a download, chunk by chunk
+def send_bytes(data, filename):
+    def chunks():
+        view = memoryview(data)
+        for start in range(0, len(view), CHUNK_SIZE):
+            yield view[start:start + CHUNK_SIZE].tobytes()
+    return Response(chunks(), mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename, 'Content-Length': str(len(data))})
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
+# Read the action and the uploaded file of the form, returns (action, data), or (None, response) when the form is invalid
+def read_upload():
     if 'file' not in request.files:
-        return 'No file part'
-    
+        return None, 'No file part'
+
     file = request.files['file']
-    
+
     if file.filename == '':
-        return 'No selected file'
-    
+        return None, 'No selected file'
+
     action = request.form.get('action')
-    
-    if file and action == 'encode':
-        filename = 'uploaded.txt'
-        file.save(filename)
-        with open(filename, "r") as f:
-            string = f.read()
-        if string[-1] != '$':
-            string += '$'
-        encoder = RunLengthEncoder(string)
-        return send_file('encoder_output.bin', as_attachment=True)
+    if action not in ('encode', 'decode'):
+        return None, ('Unknown action', 400)
+
+    # the upload stays in memory, nothing is written to disk
+    return action, file.read()
+
+# Name of the download of the result of the action
+def result_filename(action):
+    return 'encoder_output.bin' if action == 'encode' else 'decoder_output.txt'
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    action, data = read_upload()
+    if action is None:
+        return data
+
+    with stage('upload.' + action, len(data)) as timer:
+        if action == 'encode':
+            try:
+                result = run_job(encode_upload, data, action)
+            except Exception:
+                reject('invalid')
+                return 'File could not be encoded', 400
+        else:
+            try:
+                result = run_job(decode_upload, data, action)
+            except Exception:
+                reject('invalid')
+                return 'Invalid encoded file', 400
+        if result is not None:
+            timer.output_size = len(result)
+
+    if result is None:
+        reject('busy')
+        return 'Server busy, try again later', 503
+    return send_bytes(result, result_filename(action))
+
+# Start a job for the upload, the form is the same as the one of /upload
+# the job is returned with 202 and its status is polled at /jobs/<id>, its result downloaded at /jobs/<id>/result
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    action, data = read_upload()
+    if action is None:
+        return data
+    job = jobs.submit(action, data, cached_job)
+    if job is None:
+        reject('busy')
+        return 'Server busy, try again later', 503
+    return jsonify(job.info()), 202, {'Location': '/jobs/' + job.id}
+
+# Status and progress of a job
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    return jsonify(job.info())
+
+# Download the result of a job, a job that is not done gets its status with 409
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    if job.status != DONE:
+        return jsonify(job.info()), 409
+    return send_bytes(job.result, result_filename(job.action))
+
+# Cancel a job, a queued job never runs and a running one stops after its current block
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    return jsonify(job.info())
+
+@app.route('/cache')
+def cache_stats():
+    return jsonify(cache.stats())
 
-    if file and action == 'decode':
-        filename = 'uploaded.bin'
-        file.save(filename)
-        decoder = RunLengthDecoder(filename)
-        return send_file('decoder_output.txt', as_attachment=True)
+# Figures of every stage aggregated over the uploads so far, with the cache and job counters and rejected uploads
+@app.route('/metrics')
+def metrics_figures():
+    with metrics.lock:
+        rejected_counts = dict(rejected)
+    return jsonify({'stages': metrics.snapshot(), 'cache': cache.stats(), 'jobs': jobs.stats(), 'rejected': rejected_counts})
 
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
+    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), threaded=True)
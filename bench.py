@@ -0,0 +1,239 @@
+# This file contains the benchmark suite of the compressor
+# Every corpus is generated from a fixed seed, so the same sizes always give the same input on every machine
+# For every corpus and size it measures the wall time of each stage, the throughput and peak memory of encoding and decoding,
+# and the compression ratio. Results are written as JSON, and can be compared against a stored baseline to flag slowdowns
+#
+# usage: python bench.py [--sizes 1000,10000,100000] [--corpora random,dna] [--method auto] [--repeat 3]
+#                        [--output results.json] [--baseline baseline.json] [--threshold 0.2]
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import numpy as np
+from encoder import BWTConverter, RunLengthEncoder, estimate_memory
+from decoder import RunLengthDecoder
+from suffix_array import build_suffix_array
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+# seed of every corpus, mixed with its size
+SEED = 33607265
+
+# characters the text mode accepts, apart from the '$' terminator
+TEXT_ALPHABET = [chr(code) for code in range(37, 127)]
+WORDS = ("the of and to in is was that for it with as his on be at by had are but from or have an they which one you were "
+         "all her she there would their we him been has when who will no more if out so up said what its about than into them "
+         "can only other time new some could these two may first then do any like my now over such our man me even most made "
+         "after also did many before must through back years where much your way well down should because each just those").split()
+LOG_LEVELS = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARN', 'ERROR']
+LOG_MESSAGES = ['request served', 'cache miss', 'connection reset by peer', 'retrying upload', 'job finished', 'block written']
+
+# A long random phrase repeated with a few mutations
+def repetitive_corpus(size, rng):
+    phrase = ''.join(rng.choices(TEXT_ALPHABET, k=97))
+    text = list((phrase * (size // len(phrase) + 1))[:size])
+    for _ in range(size // 1000):
+        text[rng.randrange(size)] = rng.choice(TEXT_ALPHABET)
+    return ''.join(text).encode('ascii')
+
+# Characters drawn uniformly from the text alphabet
+def random_corpus(size, rng):
+    return ''.join(rng.choices(TEXT_ALPHABET, k=size)).encode('ascii')
+
+# Words with a zipf distribution, separated by spaces and broken into lines
+def english_corpus(size, rng):
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    pieces = []
+    length = 0
+    while length < size:
+        sentence = ' '.join(rng.choices(WORDS, weights, k=rng.randint(5, 20)))
+        sentence = sentence[0].upper() + sentence[1:] + ('.\n' if rng.random() < 0.2 else '. ')
+        pieces.append(sentence)
+        length += len(sentence)
+    return ''.join(pieces)[:size].encode('ascii')
+
+# Bases with a few repeated motifs, like a genome
+def dna_corpus(size, rng):
+    motifs = [''.join(rng.choices('ACGT', k=rng.randint(8, 40))) for _ in range(20)]
+    pieces = []
+    length = 0
+    while length < size:
+        piece = rng.choice(motifs) if rng.random() < 0.3 else ''.join(rng.choices('ACGT', k=rng.randint(1, 30)))
+        pieces.append(piece)
+        length += len(piece)
+    return ''.join(pieces)[:size].encode('ascii')
+
+# Lines of a server log with timestamps, levels, ids and messages
+def log_corpus(size, rng):
+    pieces = []
+    length = 0
+    timestamp = 1700000000
+    while length < size:
+        timestamp += rng.randint(0, 5)
+        line = '%d %-5s worker-%d id=%08x %s\n' % (timestamp, rng.choice(LOG_LEVELS), rng.randint(1, 8),
+                                                   rng.getrandbits(32), rng.choice(LOG_MESSAGES))
+        pieces.append(line)
+        length += len(line)
+    return ''.join(pieces)[:size].encode('ascii')
+
+CORPORA = {
+    'repetitive': repetitive_corpus,
+    'random': random_corpus,
+    'english': english_corpus,
+    'dna': dna_corpus,
+    'log': log_corpus,
+}
+
+# Generate the corpus of the given size, always the same for the same name and size
+def generate(name, size):
+    return CORPORA[name](size, random.Random('%s-%d-%d' % (name, size, SEED)))
+
+# Get the input of the encoder for the corpus, text when every byte is in the text alphabet and bytes otherwise
+def encoder_input(data):
+    if all(37 <= byte <= 126 for byte in set(data)):
+        return 'text', data.decode('ascii') + '$'
+    return 'bytes', data
+
+# Smallest wall time of repeat calls of func, with the result of the last call
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+# Peak memory allocated while calling func, numpy arrays are traced too
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Benchmark one corpus and size, returns its result
+def run_case(name, size, method='auto', repeat=3, use_mtf=False):
+    data = generate(name, size)
+    mode, string = encoder_input(data)
+
+    def encode():
+        return RunLengthEncoder(string, method, output_file=None, use_mtf=use_mtf).to_bytes()
+
+    stages = {}
+    stages['suffix_array'], _ = best_time(lambda: build_suffix_array(string, method), repeat)
+    stages['bwt'], _ = best_time(lambda: BWTConverter(string, method).convert_array(), repeat)
+    stages['encode'], encoded = best_time(encode, repeat)
+    stages['decode'], decoder = best_time(lambda: RunLengthDecoder(encoded, output_file=None), repeat)
+    stages['inverse_bwt'], decoded = best_time(decoder.inverse_bwt, repeat)
+    # the entropy coding stages are what is left after the BWT and its inverse, they are the difference of two timings
+    # so they are too noisy to compare against a baseline
+    derived = {
+        'entropy_encode': max(stages['encode'] - stages['bwt'], 0.0),
+        'entropy_decode': max(stages['decode'] - stages['inverse_bwt'], 0.0),
+    }
+    if decoded != string:
+        raise AssertionError("%s corpus of size %d did not round trip" % (name, size))
+
+    return {
+        'corpus': name,
+        'size': size,
+        'mode': mode,
+        'method': method,
+        'use_mtf': use_mtf,
+        'stages': stages,
+        'derived': derived,
+        'encode_mb_per_s': size / stages['encode'] / 1e6,
+        'decode_mb_per_s': size / stages['decode'] / 1e6,
+        'encode_peak_bytes': peak_memory(encode),
+        # what the memory budget of the encoder expects the peak to be, to check the estimate against the measured peak
+        'encode_estimate_bytes': estimate_memory(len(string), method),
+        'decode_peak_bytes': peak_memory(lambda: RunLengthDecoder(encoded, output_file=None)),
+        'compressed_bytes': len(encoded),
+        'ratio': len(encoded) / size,
+    }
+
+# Run every corpus at every size, returns the results with a description of the machine
+def run(corpora=None, sizes=DEFAULT_SIZES, method='auto', repeat=3, use_mtf=False, log=None):
+    results = []
+    for name in corpora or list(CORPORA):
+        for size in sizes:
+            result = run_case(name, size, method, repeat, use_mtf)
+            if log is not None:
+                log(format_result(result))
+            results.append(result)
+    return {
+        'machine': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+        },
+        'settings': {'method': method, 'repeat': repeat, 'use_mtf': use_mtf, 'sizes': list(sizes)},
+        'results': results,
+    }
+
+# One line summary of a result
+def format_result(result):
+    return "%-10s %9d %-5s encode %8.4fs (%6.2f MB/s) decode %8.4fs (%6.2f MB/s) ratio %.3f peak %.1f/%.1f MB" % (
+        result['corpus'], result['size'], result['mode'], result['stages']['encode'], result['encode_mb_per_s'],
+        result['stages']['decode'], result['decode_mb_per_s'], result['ratio'],
+        result['encode_peak_bytes'] / 1e6, result['decode_peak_bytes'] / 1e6)
+
+# Compare results against a baseline, returns the list of regressions
+# a stage regresses when it is slower than the baseline by more than threshold (0.2 is 20%), ignoring stages faster than min_time,
+# which are too short to time reliably. Peak memory and compressed size are compared the same way
+def compare(results, baseline, threshold=0.2, min_time=0.001):
+    regressions = []
+    base = {(r['corpus'], r['size']): r for r in baseline['results']}
+    for result in results['results']:
+        old = base.get((result['corpus'], result['size']))
+        if old is None:
+            continue
+        checks = [('stage ' + stage, seconds, old['stages'].get(stage)) for stage, seconds in result['stages'].items()
+                  if seconds >= min_time]
+        checks.append(('encode peak memory', result['encode_peak_bytes'], old['encode_peak_bytes']))
+        checks.append(('decode peak memory', result['decode_peak_bytes'], old['decode_peak_bytes']))
+        checks.append(('compressed size', result['compressed_bytes'], old['compressed_bytes']))
+        for what, new_value, old_value in checks:
+            if old_value and new_value > old_value * (1 + threshold):
+                regressions.append({
+                    'corpus': result['corpus'],
+                    'size': result['size'],
+                    'metric': what,
+                    'baseline': old_value,
+                    'value': new_value,
+                    'change': new_value / old_value - 1,
+                })
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark every stage of the compressor")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help="comma separated corpus sizes in bytes")
+    parser.add_argument('--corpora', default=','.join(CORPORA), help="comma separated corpus names")
+    parser.add_argument('--method', default='auto', help="suffix array engine")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs of every stage, the fastest is kept")
+    parser.add_argument('--mtf', action='store_true', help="use the move-to-front stage")
+    parser.add_argument('--output', help="file to write the JSON results to")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = run(args.corpora.split(','), [int(size) for size in args.sizes.split(',')], args.method, args.repeat, args.mtf,
+                  log=print)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION %(corpus)s %(size)d %(metric)s: %(baseline).6g -> %(value).6g (%(change)+.1f%%)"
+                  % dict(regression, change=regression['change'] * 100))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,169 @@
+# This file contains the bit level input and output shared by encoder.py, decoder.py and fmindex.py
+# Bits are written and read most significant bit first, the same order bitarray uses
+# BitWriter packs the bits into an integer accumulator and moves them to a bytearray a 64-bit word at a time,
+# long runs of bits (a data part coded by bitarray) are appended as bytes after the few bits still in the accumulator
+# BitReader reads from a bytes-like buffer through a cached 64-bit word, refilled only when a read runs past it
+#
+# usage:
+#   writer = BitWriter()
+#   writer.write(5, 3)
+#   writer.write_elias(42)
+#   reader = BitReader(writer.getvalue())
+#   reader.read(3), reader.read_elias()
+
+import elias
+from bitarray import bitarray
+from bitarray.util import ba2int, int2ba
+
+WORD_BITS = 64
+WORD_BYTES = WORD_BITS >> 3
+# longest peek served by the cached word, a word starts at a byte boundary so up to 7 of its bits are behind the position
+MAX_PEEK_BITS = WORD_BITS - 7
+
+class BitWriter:
+    def __init__(self):
+        # whole words written so far
+        self.data = bytearray()
+        # bits not yet moved to data and how many there are
+        self.acc = 0
+        self.count = 0
+
+    # Number of bits written
+    def __len__(self):
+        return (len(self.data) << 3) + self.count
+
+    # Write the n bits of value, value must be from 0 to 2 ** n - 1
+    def write(self, value, n):
+        if value >> n:
+            raise ValueError("%d does not fit in %d bits" % (value, n))
+        self.acc = (self.acc << n) | value
+        self.count += n
+        while self.count >= WORD_BITS:
+            self.count -= WORD_BITS
+            self.data += (self.acc >> self.count).to_bytes(WORD_BYTES, 'big')
+            self.acc &= (1 << self.count) - 1
+
+    # Write the elias omega code of a positive number
+    def write_elias(self, num):
+        self.write(*elias.encode_value(num))
+
+    # Write the bits of a bitarray, a long one is appended as bytes instead of going through the accumulator
+    def write_bits(self, bits):
+        if len(bits) <= WORD_BITS:
+            if bits:
+                self.write(ba2int(bits), len(bits))
+            return
+        # move the whole bytes of the accumulator, the bits left over go in front of the bitarray
+        self.align_acc()
+        head = bitarray(format(self.acc, '0%db' % self.count)) if self.count else bitarray()
+        head += bits
+        # the bits past the last whole byte go back to the accumulator
+        tail = len(head) & 7
+        self.acc = ba2int(head[len(head) - tail:]) if tail else 0
+        self.count = tail
+        del head[len(head) - tail:]
+        self.data += head.tobytes()
+
+    # Write the code word of every symbol, code_words maps a symbol to its code word as a bitarray
+    # the code words are joined by bitarray in one pass
+    def write_codes(self, code_words, symbols):
+        bits = bitarray()
+        bits.encode(code_words, symbols)
+        self.write_bits(bits)
+
+    # Write zero bits up to the next byte boundary
+    def align(self):
+        self.write(0, -self.count & 7)
+
+    # Write whole bytes, the writer must be at a byte boundary
+    def write_bytes(self, data):
+        if self.count & 7:
+            raise ValueError("bytes can only be written at a byte boundary")
+        self.align_acc()
+        self.data += data
+
+    # Move the whole bytes of the accumulator to data, leaving fewer than 8 bits in it
+    def align_acc(self):
+        whole = self.count >> 3
+        if whole:
+            self.count &= 7
+            self.data += (self.acc >> self.count).to_bytes(whole, 'big')
+            self.acc &= (1 << self.count) - 1
+
+    # Get the bits written as bytes, the last byte is padded with zeros
+    def getvalue(self):
+        pad = -self.count & 7
+        return bytes(self.data) + (self.acc << pad).to_bytes((self.count + pad) >> 3, 'big')
+
+    # Get the bits written as a bitarray of the exact length
+    def to_bitarray(self):
+        bits = bitarray()
+        bits.frombytes(self.getvalue())
+        del bits[len(self):]
+        return bits
+
+# data is any bytes-like object, pos is the bit position to start at, reads past the end give zeros
+class BitReader:
+    def __init__(self, data, pos=0):
+        self.data = memoryview(data).cast('B') if not isinstance(data, bytes) else data
+        self.pos = pos
+        # cached word and the bit position of its first bit, -1 before the first refill
+        self.word = 0
+        self.word_pos = -1
+
+    # Get the next n bits as a number without moving the position
+    def peek(self, n):
+        pos = self.pos
+        end = pos + n
+        if self.word_pos < 0 or pos < self.word_pos or end > self.word_pos + WORD_BITS:
+            if n > MAX_PEEK_BITS:
+                return self.peek_long(n)
+            self.refill()
+        return (self.word >> (self.word_pos + WORD_BITS - end)) & ((1 << n) - 1)
+
+    # Load the word that starts at the byte of the position
+    def refill(self):
+        byte = self.pos >> 3
+        chunk = self.data[byte:byte + WORD_BYTES]
+        self.word = int.from_bytes(chunk, 'big') << ((WORD_BYTES - len(chunk)) << 3)
+        self.word_pos = byte << 3
+
+    # Peek more bits than the cached word holds, straight from the buffer
+    def peek_long(self, n):
+        byte = self.pos >> 3
+        size = ((self.pos & 7) + n + 7) >> 3
+        chunk = self.data[byte:byte + size]
+        value = int.from_bytes(chunk, 'big') << ((size - len(chunk)) << 3)
+        return (value >> ((size << 3) - (self.pos & 7) - n)) & ((1 << n) - 1)
+
+    # Read the next n bits as a number
+    def read(self, n):
+        value = self.peek(n)
+        self.pos += n
+        return value
+
+    # Move the position n bits forward
+    def skip(self, n):
+        self.pos += n
+
+    # Move to the given bit position
+    def seek(self, pos):
+        self.pos = pos
+
+    # Read the next n bits as a bitarray
+    def read_bits(self, n):
+        if n == 0:
+            return bitarray()
+        return int2ba(self.read(n), n)
+
+    # Read an elias omega code
+    def read_elias(self):
+        # the first group is 1 bit long
+        group_len = 1
+        while True:
+            value = self.read(group_len)
+            # the last group starts with 1 and is the number itself
+            if value >> (group_len - 1):
+                return value
+            # otherwise put back the leading 1 to get the length of the next group minus one
+            group_len = (value | (1 << (group_len - 1))) + 1
@@ -0,0 +1,518 @@
+# This file contains the block mode of the compressor, in the style of bzip2
+# The input is read in fixed-size blocks, every block is compressed on its own by RunLengthEncoder,
+# and the results are written to a framed container so memory is bounded by the block size instead of the file size
+# Since blocks are independent, they can also be compressed and decompressed on several processes at once
+# Blocks are either text, which gets the '$' terminator, or binary data, which RunLengthEncoder codes over the full 0-255 alphabet
+#
+# Container layout:
+#   MAGIC
+#   for every block: block header (number of characters in the block, number of payload bytes) followed by the payload
+#   end marker: a block header with both values 0
+#   optional seek index: number of blocks, then for every block its start in the original data and the offset of its block header
+#   index trailer: length of the original data, offset of the seek index, whether the blocks are bytes, INDEX_MAGIC
+# The seek index lets decode_range decode only the blocks that overlap a range, readers that stop at the end marker ignore it
+# With the dedup option, the input is cut into content-defined chunks by a rolling hash, and a chunk seen before in the last
+# DEDUP_WINDOW characters becomes a reference frame instead of being compressed again:
+#   reference frame: a block header (number of characters, REFERENCE) followed by the start in the original data to copy from
+# the decoder copies the characters from the blocks it already decoded. Containers that may hold reference frames start with
+# DEDUP_MAGIC instead of MAGIC, so the decoder only keeps the last DEDUP_WINDOW characters for them
+# append_stream adds blocks to an existing container: the new blocks overwrite the end marker and the seek index,
+# and a new end marker and seek index are written after them, so appending never touches the blocks already there
+# the new blocks are compressed to a temporary file first, so the container is only written once every block is encoded
+
+import bisect
+import hashlib
+import io
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import numpy as np
+from collections import deque
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from encoder import RunLengthEncoder, max_encode_length
+from decoder import RunLengthDecoder
+
+MAGIC = b'BWTB'
+DEDUP_MAGIC = b'BWTR'
+BLOCK_HEADER = struct.Struct('>II')
+INDEX_MAGIC = b'BWTI'
+INDEX_COUNT = struct.Struct('>I')
+INDEX_ENTRY = struct.Struct('>QQ')
+INDEX_TRAILER = struct.Struct('>QQ?4s')
+# default number of characters per block, same as the largest bzip2 block
+DEFAULT_BLOCK_SIZE = 900000
+# smallest block a memory budget shrinks blocks to before it runs fewer workers, smaller blocks compress worse
+MIN_BUDGET_BLOCK_SIZE = 64 * 1024
+# terminator appended to every text block before the BWT
+TERMINATOR = '$'
+# any character a text block cannot hold, text blocks only hold the characters above the terminator up to '~'
+NOT_TEXT = re.compile('[^%-~]')
+# payload length of the block header of a reference frame, followed by REFERENCE_SOURCE instead of a payload
+REFERENCE = 0xFFFFFFFF
+REFERENCE_SOURCE = struct.Struct('>Q')
+# how far back a reference frame may point, the decoder of a dedup container keeps this many characters of decoded blocks
+DEDUP_WINDOW = 16 << 20
+# smallest and largest chunk, in between a chunk ends after a character whose rolling hash has the DEDUP_MASK bits all zero,
+# which happens every 8K characters on average
+DEDUP_MIN_CHUNK = 2 * 1024
+DEDUP_MAX_CHUNK = 64 * 1024
+DEDUP_MASK = ((1 << 13) - 1) << 19
+# random 32-bit value of every byte value for the gear hash, the hash of a position covers the 32 characters up to it
+GEAR = np.random.RandomState(0x42575452).randint(0, 1 << 32, 256, dtype=np.uint64).astype(np.uint32)
+
+# Compress one block of text or bytes to the bytes of its payload, options are passed to RunLengthEncoder
+def encode_block(block, **options):
+    if isinstance(block, str):
+        invalid = NOT_TEXT.search(block)
+        if invalid:
+            raise ValueError("text can only hold the characters '%%' to '~', not %r, code other text as bytes"
+                             % invalid.group())
+        block += TERMINATOR
+    return RunLengthEncoder(block, output_file=None, **options).to_bytes()
+
+# Decode the payload of one block back to its text or bytes
+def decode_block(payload):
+    block = RunLengthDecoder(payload, output_file=None).original_data
+    # drop the terminator added by encode_block
+    if isinstance(block, str):
+        block = block[:-1]
+    return block
+
+# Compress one block to its frame, the block header followed by the payload
+def encode_frame(block, **options):
+    payload = encode_block(block, **options)
+    return BLOCK_HEADER.pack(len(block), len(payload)) + payload
+
+# Get the frame of a reference to the block_length characters of the original data at source
+def encode_reference(block_length, source):
+    return BLOCK_HEADER.pack(block_length, REFERENCE) + REFERENCE_SOURCE.pack(source)
+
+# Compress one item of dedup_items to its frame, a (block length, source) pair is a reference
+def encode_item(item, **options):
+    if isinstance(item, tuple):
+        return encode_reference(*item)
+    return encode_frame(item, **options)
+
+# Decode one (block length, payload) pair read from the container and check its length
+# the (block length, source) pair of a reference frame is returned as it is, for resolve_references
+def decode_frame(frame):
+    block_length, payload = frame
+    if isinstance(payload, int):
+        return frame
+    block = decode_block(payload)
+    if len(block) != block_length:
+        raise ValueError("block decoded to %d characters, expected %d" % (len(block), block_length))
+    return block
+
+# Apply func to every item and yield the results in the same order as the items
+# with more than one worker, the items are processed by a pool of processes, and at most 2 items per worker are in flight
+# so memory stays bounded by the block size. workers=None uses every cpu core
+def ordered_map(func, items, workers=1):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# Fit the block size and the number of workers to a memory budget in bytes shared by the workers, returns both
+# blocks shrink first, down to MIN_BUDGET_BLOCK_SIZE, then fewer workers run so each one gets a larger share of the budget
+# raises MemoryError when even one worker cannot encode a block of one character
+def fit_blocks(block_size, workers, max_memory):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(workers, 1)
+    while workers > 1 and max_encode_length(max_memory // workers) - 1 < min(block_size, MIN_BUDGET_BLOCK_SIZE):
+        workers -= 1
+    # text blocks get the terminator on top of their characters
+    length = max_encode_length(max_memory // workers) - 1
+    if length < 1:
+        raise MemoryError("the budget of %d bytes is too small to encode any block" % max_memory)
+    return min(block_size, length), workers
+
+# Generator over the blocks of the file object, text or bytes depending on the mode it was opened in
+def read_blocks(fileobj, block_size):
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            return
+        yield block
+
+# Positions where the chunks of the text or bytes end, the data must start at the start of a chunk
+# the end of the data is not included, the characters after the last position are the start of a chunk not yet complete
+def chunk_boundaries(data):
+    values = np.frombuffer(data.encode('latin-1') if isinstance(data, str) else data, dtype=np.uint8)
+    gear = GEAR[values]
+    # gear hash of every position, the sum of the gear values of the last 32 characters shifted by their distance
+    hashes = gear.copy()
+    for shift in range(1, 32):
+        hashes[shift:] += gear[:len(gear) - shift] << np.uint32(shift)
+    boundaries = []
+    last = 0
+    for end in (np.flatnonzero((hashes & np.uint32(DEDUP_MASK)) == 0) + 1).tolist():
+        while end - last > DEDUP_MAX_CHUNK:
+            last += DEDUP_MAX_CHUNK
+            boundaries.append(last)
+        if end - last >= DEDUP_MIN_CHUNK:
+            boundaries.append(end)
+            last = end
+    while len(values) - last > DEDUP_MAX_CHUNK:
+        last += DEDUP_MAX_CHUNK
+        boundaries.append(last)
+    return boundaries
+
+# Generator over the content-defined chunks of the blocks, a chunk that did not end in a block carries over to the next one
+def content_chunks(blocks):
+    tail = None
+    for block in blocks:
+        data = block if tail is None else tail + block
+        last = 0
+        for end in chunk_boundaries(data):
+            yield data[last:end]
+            last = end
+        tail = data[last:]
+    if tail:
+        yield tail
+
+# Generator over the items to write for the blocks starting at start in the original data: blocks of at most block_size
+# characters holding the chunks not seen before, and (block length, source) pairs for the runs of chunks seen before
+# the fingerprint index maps the sha256 of every chunk of the last DEDUP_WINDOW characters to its start
+def dedup_items(blocks, block_size, start):
+    fingerprints = {}
+    # (start, fingerprint) of the chunks in the index, oldest first
+    order = deque()
+    # new chunks not yet yielded and their length, or the reference being extended, never both at once
+    pending = []
+    pending_length = 0
+    reference = None
+    position = start
+    for chunk in content_chunks(blocks):
+        while order and order[0][0] < position - DEDUP_WINDOW:
+            old_start, old_fingerprint = order.popleft()
+            del fingerprints[old_fingerprint]
+        fingerprint = hashlib.sha256(chunk.encode('latin-1') if isinstance(chunk, str) else chunk).digest()
+        source = fingerprints.get(fingerprint)
+        if source is None:
+            if reference is not None:
+                yield reference
+                reference = None
+            fingerprints[fingerprint] = position
+            order.append((position, fingerprint))
+            pending.append(chunk)
+            pending_length += len(chunk)
+            if pending_length >= block_size:
+                data = chunk[:0].join(pending)
+                cut = pending_length - pending_length % block_size
+                for block_start in range(0, cut, block_size):
+                    yield data[block_start:block_start + block_size]
+                pending = [data[cut:]]
+                pending_length -= cut
+        else:
+            if pending_length:
+                yield chunk[:0].join(pending)
+                pending = []
+                pending_length = 0
+            # a chunk that follows the previous copy in the original data extends the same reference
+            if (reference is not None and reference[1] + reference[0] == source
+                    and reference[0] + len(chunk) <= block_size):
+                reference = (reference[0] + len(chunk), reference[1])
+            else:
+                if reference is not None:
+                    yield reference
+                reference = (len(chunk), source)
+        position += len(chunk)
+    if reference is not None:
+        yield reference
+    if pending_length:
+        yield pending[0][:0].join(pending)
+
+# Read the magic number of a container, returns how many characters of decoded blocks its reference frames may point back
+def read_magic(fileobj):
+    magic = fileobj.read(len(MAGIC))
+    if magic == MAGIC:
+        return 0
+    if magic == DEDUP_MAGIC:
+        return DEDUP_WINDOW
+    raise ValueError("not a block container")
+
+# Whether the bytes start with the magic number of a block container
+def is_container(data):
+    return data[:len(MAGIC)] in (MAGIC, DEDUP_MAGIC)
+
+# Read the frame at the position of the file object, returns (block length, payload) for a block,
+# (block length, source) for a reference frame and None for the end marker
+def read_frame(fileobj):
+    block_length, payload_length = BLOCK_HEADER.unpack(read_exact(fileobj, BLOCK_HEADER.size))
+    if block_length == 0:
+        return None
+    if payload_length == REFERENCE:
+        return block_length, REFERENCE_SOURCE.unpack(read_exact(fileobj, REFERENCE_SOURCE.size))[0]
+    return block_length, read_exact(fileobj, payload_length)
+
+# Generator over the (block length, payload) pairs of a container, the magic number must already be read
+def read_frames(fileobj):
+    while True:
+        frame = read_frame(fileobj)
+        if frame is None:
+            return
+        yield frame
+
+# Generator over the decoded blocks in order, with the (block length, source) pairs of reference frames replaced by the
+# characters they copy, window is how many characters of the blocks before are kept for them
+def resolve_references(blocks, window):
+    # start in the original data of every block kept, and the blocks
+    starts = []
+    kept = []
+    end = 0
+    for block in blocks:
+        if isinstance(block, tuple):
+            block_length, source = block
+            if source < end - window or source + block_length > end:
+                raise ValueError("reference frame points outside the dedup window")
+            pieces = []
+            first = bisect.bisect_right(starts, source) - 1
+            for i in range(first, bisect.bisect_left(starts, source + block_length)):
+                pieces.append(kept[i][max(source - starts[i], 0):source + block_length - starts[i]])
+            block = pieces[0][:0].join(pieces)
+        starts.append(end)
+        kept.append(block)
+        end += len(block)
+        # drop the blocks that end before the window
+        drop = bisect.bisect_right(starts, end - window) - 1
+        if drop > 0:
+            del starts[:drop]
+            del kept[:drop]
+        yield block
+
+# Read exactly size bytes from the file object, raise an error if the container is cut short
+def read_exact(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise ValueError("truncated block container")
+    return data
+
+# Generator that reads text or bytes from the file object block by block and yields the bytes of the container
+# workers is the number of processes compressing blocks at once, options (such as method or use_mtf) are passed to RunLengthEncoder
+# index writes the seek index after the end marker
+# the max_memory option is a budget in bytes shared by the workers, the blocks are made small enough to fit it, see fit_blocks
+# the dedup option writes chunks seen before as reference frames, see dedup_items
+def compress_stream(fileobj, block_size=DEFAULT_BLOCK_SIZE, workers=1, index=True, **options):
+    if block_size <= 0:
+        raise ValueError("block_size must be positive")
+    yield DEDUP_MAGIC if options.get('dedup') else MAGIC
+    yield from encode_stream(fileobj, block_size, workers, index, [], 0, len(MAGIC), **options)
+
+# Generator over the frames of the blocks read from the file object, followed by the end marker and the seek index
+# entries holds the (start in the original data, offset of the block header) of the blocks already in the container,
+# start is the length of their original data and offset is where the first new block header goes
+def encode_stream(fileobj, block_size, workers, index, entries, start, offset, **options):
+    dedup = options.pop('dedup', False)
+    if options.get('max_memory') is not None:
+        block_size, workers = fit_blocks(block_size, workers, options['max_memory'])
+        options['max_memory'] //= workers
+    blocks = read_blocks(fileobj, block_size)
+    # whether the blocks are bytes comes from the first block, or from the file object when there is no data
+    first = next(blocks, None)
+    if first is None:
+        binary = not isinstance(fileobj, io.TextIOBase)
+    else:
+        binary = isinstance(first, bytes)
+        blocks = chain([first], blocks)
+    if dedup:
+        frames = ordered_map(partial(encode_item, **options), dedup_items(blocks, block_size, start), workers)
+    else:
+        frames = ordered_map(partial(encode_frame, **options), blocks, workers)
+    yield from write_frames(frames, binary, index, entries, start, offset)
+
+# Generator over the given frames in order, followed by the end marker and the seek index
+# entries, start and offset are the same as for encode_stream, binary is whether the blocks are bytes
+def write_frames(frames, binary, index, entries, start, offset):
+    for frame in frames:
+        entries.append((start, offset))
+        start += BLOCK_HEADER.unpack_from(frame)[0]
+        offset += len(frame)
+        yield frame
+    yield BLOCK_HEADER.pack(0, 0)
+    if index:
+        yield encode_index(entries, start, offset + BLOCK_HEADER.size, binary)
+
+# Find the end of the blocks of a seekable container
+# returns (offset of the end marker, entries of its blocks, length of the original data, whether the blocks are bytes)
+# the seek index gives them directly, otherwise the block headers are read one after the other without decoding the blocks,
+# and whether the blocks are bytes is None
+def find_end(fileobj):
+    try:
+        starts, offsets, total_length, binary = read_index(fileobj)
+    except ValueError:
+        pass
+    else:
+        fileobj.seek(0, os.SEEK_END)
+        end = (fileobj.tell() - INDEX_TRAILER.size - INDEX_ENTRY.size * len(starts) - INDEX_COUNT.size
+               - BLOCK_HEADER.size)
+        fileobj.seek(end)
+        if BLOCK_HEADER.unpack(read_exact(fileobj, BLOCK_HEADER.size)) != (0, 0):
+            raise ValueError("seek index does not match the block container")
+        return end, list(zip(starts, offsets)), total_length, binary
+
+    fileobj.seek(0)
+    read_magic(fileobj)
+    entries = []
+    total_length = 0
+    while True:
+        offset = fileobj.tell()
+        block_length, payload_length = BLOCK_HEADER.unpack(read_exact(fileobj, BLOCK_HEADER.size))
+        if block_length == 0:
+            return offset, entries, total_length, None
+        entries.append((total_length, offset))
+        total_length += block_length
+        fileobj.seek(REFERENCE_SOURCE.size if payload_length == REFERENCE else payload_length, os.SEEK_CUR)
+
+# Compress the text or bytes read from fileobj as new blocks at the end of the container in the seekable binary file object
+# only the new data is compressed, the blocks already in the container are kept as they are
+# with the dedup option, the new blocks only refer to each other and the container is marked with DEDUP_MAGIC
+def append_stream(container, fileobj, block_size=DEFAULT_BLOCK_SIZE, workers=1, index=True, **options):
+    if block_size <= 0:
+        raise ValueError("block_size must be positive")
+    end, entries, total_length, binary = find_end(container)
+    if entries and binary is not None and binary == isinstance(fileobj, io.TextIOBase):
+        raise ValueError("cannot append %s to a container of %s" % (('text', 'bytes') if binary else ('bytes', 'text')))
+    # a block that fails to encode leaves the container as it was
+    with tempfile.TemporaryFile() as spool:
+        for chunk in encode_stream(fileobj, block_size, workers, index, entries, total_length, end, **options):
+            spool.write(chunk)
+        spool.seek(0)
+        container.seek(end)
+        shutil.copyfileobj(spool, container)
+    # the old seek index may be longer than what was written over it
+    container.truncate()
+    if options.get('dedup'):
+        container.seek(0)
+        container.write(DEDUP_MAGIC)
+    container.flush()
+
+# Get the bytes of the seek index and its trailer, the index starts at the given offset of the container
+def encode_index(entries, total_length, offset, binary):
+    parts = [INDEX_COUNT.pack(len(entries))]
+    parts.extend(INDEX_ENTRY.pack(start, frame_offset) for start, frame_offset in entries)
+    parts.append(INDEX_TRAILER.pack(total_length, offset, binary, INDEX_MAGIC))
+    return b''.join(parts)
+
+# Read the seek index of a seekable container
+# returns (list of block starts, list of block header offsets, length of the original data, whether the blocks are bytes)
+# raise an error if the container has no seek index
+def read_index(fileobj):
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    if size < len(MAGIC) + BLOCK_HEADER.size + INDEX_COUNT.size + INDEX_TRAILER.size:
+        raise ValueError("block container has no seek index")
+    fileobj.seek(size - INDEX_TRAILER.size)
+    total_length, offset, binary, magic = INDEX_TRAILER.unpack(read_exact(fileobj, INDEX_TRAILER.size))
+    if magic != INDEX_MAGIC:
+        raise ValueError("block container has no seek index")
+    fileobj.seek(offset)
+    count, = INDEX_COUNT.unpack(read_exact(fileobj, INDEX_COUNT.size))
+    starts = []
+    offsets = []
+    for start, frame_offset in INDEX_ENTRY.iter_unpack(read_exact(fileobj, count * INDEX_ENTRY.size)):
+        starts.append(start)
+        offsets.append(frame_offset)
+    return starts, offsets, total_length, binary
+
+# Decode the characters (or bytes) from start up to end of the container in the seekable binary file object
+# only the blocks that overlap the range are read and decoded, so the work depends on the range and the block size
+def decode_range(fileobj, start, end):
+    starts, offsets, total_length, binary = read_index(fileobj)
+    return (b'' if binary else '').join(range_pieces(fileobj, starts, offsets, max(start, 0), min(end, total_length)))
+
+# Decode the pieces of the blocks that overlap the range from start to end, with the seek index read by decode_range
+# a reference frame decodes the range it copies, which is only made of blocks
+def range_pieces(fileobj, starts, offsets, start, end):
+    pieces = []
+    if start < end:
+        # the block that holds start, then every block up to the one that holds end - 1
+        first = bisect.bisect_right(starts, start) - 1
+        last = bisect.bisect_right(starts, end - 1) - 1
+        for i in range(first, last + 1):
+            fileobj.seek(offsets[i])
+            block_length, payload = read_frame(fileobj)
+            piece_start = max(start - starts[i], 0)
+            piece_end = min(end - starts[i], block_length)
+            if isinstance(payload, int):
+                pieces.extend(range_pieces(fileobj, starts, offsets, payload + piece_start, payload + piece_end))
+            else:
+                pieces.append(decode_frame((block_length, payload))[piece_start:piece_end])
+    return pieces
+
+# Decode the characters (or bytes) from start up to end of the block container at src
+def decode_file_range(src, start, end):
+    with open(src, "rb") as infile:
+        return decode_range(infile, start, end)
+
+# Generator that reads a container from the binary file object and yields the text or bytes of every block in order
+# workers is the number of processes decompressing blocks at once
+def decompress_stream(fileobj, workers=1):
+    window = read_magic(fileobj)
+    yield from resolve_references(ordered_map(decode_frame, read_frames(fileobj), workers), window)
+
+# Compress the file at src to a block container at dst, any file is read as bytes unless binary is False
+# text blocks only hold the characters '%' to '~', so most text files (every one with spaces or newlines) must be read as bytes
+def compress_file(src, dst, block_size=DEFAULT_BLOCK_SIZE, workers=1, binary=True, index=True, **options):
+    with open(src, "rb" if binary else "r") as infile, open(dst, "wb") as outfile:
+        for chunk in compress_stream(infile, block_size, workers, index, **options):
+            outfile.write(chunk)
+
+# Compress the file at src as new blocks at the end of the block container at dst, which is created if it does not exist
+# the file is read as bytes unless binary is False, which a container of text blocks needs
+def append_file(src, dst, block_size=DEFAULT_BLOCK_SIZE, workers=1, binary=True, index=True, **options):
+    if not os.path.exists(dst):
+        return compress_file(src, dst, block_size, workers, binary, index, **options)
+    with open(src, "rb" if binary else "r") as infile, open(dst, "r+b") as container:
+        append_stream(container, infile, block_size, workers, index, **options)
+
+# Decompress the block container at src to the file at dst, text blocks only hold ascii characters
+def decompress_file(src, dst, workers=1):
+    with open(src, "rb") as infile, open(dst, "wb") as outfile:
+        for block in decompress_stream(infile, workers):
+            if isinstance(block, str):
+                block = block.encode('ascii')
+            outfile.write(block)
+
+if __name__ == "__main__":
+    # usage: python blocks.py encode input output [block_size] [workers]
+    #        python blocks.py encode-text input output [block_size] [workers]
+    #        python blocks.py append input container [block_size] [workers]
+    #        python blocks.py append-text input container [block_size] [workers]
+    # encode and append read the input as bytes, the -text actions as text blocks, encode-bytes and append-bytes are
+    # the same as encode and append
+    #        python blocks.py decode input output [workers]
+    #        python blocks.py range input start end
+    action, src = sys.argv[1:3]
+    if action == 'range':
+        block = decode_file_range(src, int(sys.argv[3]), int(sys.argv[4]))
+        sys.stdout.buffer.write(block if isinstance(block, bytes) else block.encode('ascii'))
+        sys.exit(0)
+    dst = sys.argv[3]
+    if action in ('encode', 'encode-bytes', 'encode-text'):
+        block_size = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_BLOCK_SIZE
+        workers = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+        compress_file(src, dst, block_size, workers=workers, binary=action != 'encode-text')
+    elif action in ('append', 'append-bytes', 'append-text'):
+        block_size = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_BLOCK_SIZE
+        workers = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+        append_file(src, dst, block_size, workers=workers, binary=action != 'append-text')
+    else:
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        decompress_file(src, dst, workers)
@@ -0,0 +1,199 @@
+# This file contains the content-addressed result cache used by app.py, it can be used from python the same way
+# A result is keyed by the sha256 of the input plus the action and its options, so identical uploads are only coded once
+# Results live in an in-memory LRU tier bounded by the total size of the results in bytes,
+# and optionally in an on-disk tier under a directory, which keeps results evicted from memory and across restarts
+# the on-disk tier is an LRU too, bounded by max_disk_bytes, its least recently used files are deleted past it
+#
+# usage:
+#   cache = ResultCache(max_bytes=64 << 20, directory='cache', max_disk_bytes=1 << 30)
+#   encoded = cache.get_or_compute(data, 'encode', lambda: compress(data))
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Get the cache key of the input for the action and its options
+def cache_key(data, action, **options):
+    digest = hashlib.sha256(data)
+    # options are sorted so their order does not matter
+    digest.update(repr((action, sorted(options.items()))).encode())
+    return digest.hexdigest()
+
+class ResultCache:
+    def __init__(self, max_bytes=64 << 20, directory=None, max_disk_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        # key to result, the least recently used result is first
+        self.entries = OrderedDict()
+        # total size of the results in memory
+        self.size = 0
+        # key to the size of its file in the on-disk tier, the least recently used file is first
+        self.disk_entries = OrderedDict()
+        # total size of the files on disk
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        # requests are served on several threads
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.scan_disk()
+
+    # Get the result of the key, or None when it is not cached
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+        value = self.read_disk(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self.add(key, value)
+        return value
+
+    # Store the result of the key in memory and on disk
+    def put(self, key, value):
+        value = bytes(value)
+        with self.lock:
+            self.add(key, value)
+        self.write_disk(key, value)
+
+    # Get the result of the input for the action and options, calling compute to get it on a miss
+    def get_or_compute(self, data, action, compute, **options):
+        key = cache_key(data, action, **options)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    # Add a result to the memory tier and evict the least recently used ones past max_bytes, the lock must be held
+    def add(self, key, value):
+        # a result larger than the whole memory tier is only kept on disk
+        if len(value) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    # Index the files already in the on-disk tier, oldest first, and delete the oldest ones past max_disk_bytes
+    def scan_disk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            # temporary files are the writes of another process, or left over by one that stopped
+            if name.startswith('.tmp-'):
+                continue
+            try:
+                info = os.stat(self.path(name))
+            except FileNotFoundError:
+                continue
+            files.append((info.st_mtime, name, info.st_size))
+        with self.lock:
+            for _, name, size in sorted(files):
+                self.disk_entries[name] = size
+                self.disk_size += size
+            evicted = self.evict_disk()
+        self.unlink(evicted)
+
+    # Remove the least recently used files of the on-disk tier past max_disk_bytes from the index, the lock must be held
+    # returns their keys, for the files to be deleted once the lock is released
+    def evict_disk(self):
+        evicted = []
+        while self.disk_size > self.max_disk_bytes:
+            key, size = self.disk_entries.popitem(last=False)
+            self.disk_size -= size
+            self.disk_evictions += 1
+            evicted.append(key)
+        return evicted
+
+    # Delete the files of the keys from the on-disk tier
+    def unlink(self, keys):
+        for key in keys:
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    # Path of the result of the key in the on-disk tier
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    # Read the result of the key from the on-disk tier, or None when it is not there
+    def read_disk(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(key), "rb") as file:
+                value = file.read()
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if key in self.disk_entries:
+                self.disk_entries.move_to_end(key)
+        return value
+
+    # Write the result of the key to the on-disk tier, through a temporary file so a reader never sees half a result
+    # a result larger than the whole on-disk tier is not written
+    def write_disk(self, key, value):
+        if self.directory is None or len(value) > self.max_disk_bytes:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(value)
+            os.replace(temp_path, self.path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        with self.lock:
+            self.disk_size += len(value) - self.disk_entries.pop(key, 0)
+            self.disk_entries[key] = len(value)
+            evicted = self.evict_disk()
+        self.unlink(evicted)
+
+    # Remove every result from memory, and from disk too when disk is True
+    def clear(self, disk=False):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        if disk and self.directory is not None:
+            with self.lock:
+                self.disk_entries.clear()
+                self.disk_size = 0
+            for name in os.listdir(self.directory):
+                os.unlink(self.path(name))
+
+    # Counters of the cache
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'disk_evictions': self.disk_evictions,
+                'disk_entries': len(self.disk_entries),
+                'disk_bytes': self.disk_size,
+                'max_disk_bytes': self.max_disk_bytes,
+            }
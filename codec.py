@@ -0,0 +1,68 @@
+# This file contains the library API of the compressor, everything works in memory and nothing touches the filesystem
+#   compress(data) -> bytes and decompress(data) -> str or bytes code one stream in the .bin format
+#   compress_fileobj / decompress_fileobj code file objects through the block container of blocks.py
+#   compress_iter / decompress_iter do the same over iterators of chunks, yielding the result as it is produced
+# Text is a str without the '$' terminator, which is added and removed here, and any other data is bytes-like
+# text can only hold the characters '%' to '~', so text with spaces, newlines or '$' must be coded as bytes
+# options (method, use_mtf, fm_index, adaptive, entropy) are passed to RunLengthEncoder
+# the dedup option of the block container writes repeated chunks as references, see blocks.py
+
+import io
+from blocks import DEFAULT_BLOCK_SIZE, compress_stream, decode_block, decompress_stream, encode_block
+
+# Compress text or bytes to the bytes of one .bin stream
+def compress(data, **options):
+    return encode_block(data, **options)
+
+# Decompress the bytes of one .bin stream, returns text for text streams and bytes otherwise
+def decompress(data):
+    return decode_block(data)
+
+# File-like reader over an iterator of str or bytes chunks, only read is supported
+class ChunkReader:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        # chunk being read and the position in it
+        self.chunk = None
+        self.pos = 0
+
+    # Read up to size characters or bytes, fewer only at the end of the chunks
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self.chunk is None or self.pos == len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                self.pos = 0
+                if self.chunk is None:
+                    break
+                continue
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.pos + size)
+            pieces.append(self.chunk[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        if not pieces:
+            return b''
+        return pieces[0][:0].join(pieces)
+
+# Compress the text or binary file object to a block container written to the binary file object outfile
+def compress_fileobj(infile, outfile, block_size=DEFAULT_BLOCK_SIZE, workers=1, **options):
+    for chunk in compress_stream(infile, block_size, workers, **options):
+        outfile.write(chunk)
+
+# Decompress the block container read from the binary file object infile to outfile
+# text is written as ascii bytes unless outfile is a text file object
+def decompress_fileobj(infile, outfile, workers=1):
+    text = isinstance(outfile, io.TextIOBase)
+    for block in decompress_stream(infile, workers):
+        if isinstance(block, str) and not text:
+            block = block.encode('ascii')
+        outfile.write(block)
+
+# Generator over the bytes of the block container of the text or bytes chunks
+def compress_iter(chunks, block_size=DEFAULT_BLOCK_SIZE, workers=1, **options):
+    return compress_stream(ChunkReader(chunks), block_size, workers, **options)
+
+# Generator over the decoded blocks (str or bytes) of a block container given as chunks of bytes
+def decompress_iter(chunks, workers=1):
+    return decompress_stream(ChunkReader(chunks), workers)
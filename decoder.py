@@ -1,6 +1,17 @@
+import mmap
+import os
 import sys
-from bitarray import bitarray
+import numpy as np
+import ans
+import elias
+import mtf
+from itertools import islice
+from bitarray import bitarray, decodetree
+from bitarray.util import ba2int
+from bitio import BitReader
+from dictionary import get_dictionary
 from helper import *
+from instrument import stage
 
 # TreeNode class to be used when constructing BinaryTree for huffman code
 class TreeNode:
@@ -40,61 +51,284 @@ class BinaryTree:
     def get_next_node(self, last_node, bit):
         return last_node.right if bit else last_node.left
 
+# Lookup tables to decode a huffman code word in one step instead of one bit at a time
+# the primary table is indexed by the next primary_bits bits, and when the elias code of the run length also fits
+# in those bits, the same lookup resolves the run length too
+# code words longer than primary_bits bits are resolved by a secondary table indexed by the bits that follow
+class HuffmanTable:
+    # most extra bits a secondary table can be indexed by, so a lookup always fits in one peek of the word of BitReader
+    MAX_EXTRA_BITS = 25
+
+    def __init__(self, codes, primary_bits=12):
+        # longest huffman code word
+        self.max_length = max(len(code) for _, code in codes)
+        self.primary_bits = primary_bits
+        # each entry is (char, number of bits used, run length), the run length is 0 when its elias code did not fit and is decoded separately
+        # long code words have the entry (None, index of the secondary table, 0)
+        self.primary = [None] * (1 << primary_bits)
+        # each entry is (number of extra bits, table of (char, code word length, 0))
+        self.secondary = []
+
+        # group the long code words by their first primary_bits bits
+        long_codes = {}
+        for char, code in codes:
+            if len(code) <= primary_bits:
+                self.fill(self.primary, primary_bits, code, char, 0)
+                # overwrite the entries where the elias code of a run length follows the code word
+                run_length = 1
+                while True:
+                    elias_code = elias.encode(run_length)
+                    # elias codes never get shorter as the run length grows, so stop at the first one that does not fit
+                    if len(code) + len(elias_code) > primary_bits:
+                        break
+                    self.fill(self.primary, primary_bits, code + elias_code, char, run_length)
+                    run_length += 1
+            else:
+                long_codes.setdefault(ba2int(code[:primary_bits]), []).append((char, code))
+
+        for prefix, group in long_codes.items():
+            extra_bits = max(len(code) for _, code in group) - primary_bits
+            table = [None] * (1 << extra_bits)
+            for char, code in group:
+                self.fill(table, extra_bits, code[primary_bits:], char, 0, len(code))
+            self.primary[prefix] = (None, len(self.secondary), 0)
+            self.secondary.append((extra_bits, table))
+
+    # Set every entry of a table indexed by the given number of bits, whose index starts with the given bits
+    # the entry records length bits used, which is the length of the given bits unless stated
+    @staticmethod
+    def fill(table, bits, prefix, char, run_length, length=None):
+        entry = (char, len(prefix) if length is None else length, run_length)
+        first = ba2int(prefix) << (bits - len(prefix))
+        for i in range(first, first + (1 << (bits - len(prefix)))):
+            table[i] = entry
+
+    # Look up the code word at the position of the BitReader without moving it, returns (char, number of bits used, run length)
+    # a run length of 0 means the elias code of the run length starts after the bits used
+    def lookup(self, reader):
+        entry = self.primary[reader.peek(self.primary_bits)]
+        if entry[0] is None:
+            extra_bits, table = self.secondary[entry[1]]
+            entry = table[reader.peek(self.primary_bits + extra_bits) & ((1 << extra_bits) - 1)]
+        return entry
+
 ### MAIN CLASS ###
 # Decode the input .bin file using run-length decoding
+# file is the name of the .bin file or the encoded bytes, output_file is the file the decoded data is written to, by default it is only kept in memory
+# use_table decodes huffman code words with lookup tables, otherwise the bit path tree is walked one bit at a time
+# binary data (FLAG_BYTES) is decoded to bytes, and when it goes to a file it is rebuilt straight into the memory mapped file,
+# so original_data is None in that case
 class RunLengthDecoder:
-    def __init__(self, file):
+    def __init__(self, file, output_file=None, use_table=True):
+        self.output_file = output_file
         # convert .bin file to bitarray
         self.bit_string = self.file_to_bitarray(file)
         self.length = len(self.bit_string)
-        # pointer to current position of the bit_string which is being decoded
-        self.curr_pos = 0
+        # reader over the bytes of the bit_string, its position is the bit being decoded
+        self.reader = BitReader(memoryview(self.bit_string))
+        with stage('decode', self.length >> 3) as timer:
+            # decode the header flags, which tell the stages the encoder used
+            self.flags = self.decode_flags()
+            self.binary = bool(self.flags & FLAG_BYTES)
+            # number of bits each character takes in the header
+            self.char_bits = 8 if self.binary else 7
+            if self.flags:
+                self.decode_length()
+            # the adaptive mode of the encoder can skip the BWT, or store the input as it is
+            if self.flags & FLAG_STORED:
+                self.original_data = self.decode_stored()
+            elif self.flags & FLAG_HUFFMAN:
+                self.original_data = self.decode_huffman()
+            else:
+                self.decode_bwt(use_table)
+            timer.output_size = self.decoded_length
+        # output decoded data to file, unless it was already rebuilt into it
+        if self.output_file is not None and self.original_data is not None:
+            self.output()
+
+    # Decode data coded with the full pipeline: run-length and huffman decoding, then the inverse BWT
+    def decode_bwt(self, use_table):
+        if self.binary and self.decoded_length == 0:
+            # empty binary data has no header past its length
+            self.decoded_data = ""
+        elif self.flags & FLAG_MTF:
+            self.decoded_data = self.decode_mtf()
+        elif self.flags & FLAG_ANS:
+            self.decoded_data = self.decode_ans()
+        else:
+            self.decode_runs(use_table)
+        if self.binary and self.output_file is not None:
+            self.original_data = None
+            self.output_mapped()
+        else:
+            # inverse BWT to original data
+            self.original_data = self.inverse_bwt()
+
+    # Decode data coded with huffman code words only, the header is the same as the one of the full pipeline
+    def decode_huffman(self):
+        self.binary_tree = BinaryTree()
+        self.huffman_codes = []
+        with stage('header', self.length >> 3):
+            self.decode_header()
+        # the data part only holds huffman code words, so bitarray decodes them all in one pass
+        with stage('huffman_decode', self.length >> 3) as timer:
+            code_words = {char: code for char, code in self.huffman_codes}
+            decoded_data = ''.join(islice(self.bit_string[self.reader.pos:].iterdecode(decodetree(code_words)), self.decoded_length))
+            timer.output_size = len(decoded_data)
+        if self.binary:
+            return decoded_data.encode('latin-1')
+        return decoded_data
+
+    # Decode data stored as it is, it starts at the byte after the start of the header
+    def decode_stored(self):
+        start = (self.reader.pos + 7) >> 3
+        data = memoryview(self.bit_string)[start:start + self.decoded_length].tobytes()
+        if self.binary:
+            return data
+        return data.decode('latin-1')
+
+    # Decode the huffman code words and run lengths of the BWT, into self.decoded_data
+    def decode_runs(self, use_table):
         # build a huffman tree for decoding process
         self.binary_tree = BinaryTree()
+        # (char, huffman code) of each unique character, used to build the lookup tables
+        self.huffman_codes = []
         # decode the header part
-        self.decode_header()
+        with stage('header', self.length >> 3):
+            self.decode_header()
+            # build the lookup tables from the decoded header, the tree is kept as the fallback
+            self.huffman_table = self.build_huffman_table() if use_table else None
         # decode the data part
-        self.decoded_data = self.decode_data()
-        # inverse BWT to original data
-        self.original_data = self.inverse_bwt()
-        # output decoded data to file
-        self.output()
+        with stage('huffman_decode', self.length >> 3) as timer:
+            if self.huffman_table is not None:
+                self.decoded_data = self.decode_data_table()
+            else:
+                self.decoded_data = self.decode_data()
+            timer.output_size = len(self.decoded_data)
+
+    # Decode the models and runs coded by the tANS backend of ans.py, returns the BWT string
+    def decode_ans(self):
+        with stage('ans_decode', self.length >> 3) as timer:
+            decoded_data = ans.decode_runs(self.reader, self.decoded_length, self.char_bits)
+            timer.output_size = len(decoded_data)
+        return decoded_data
+
+    # Decode the header flags, the original header has no flags and starts with a 0 bit
+    def decode_flags(self):
+        if self.length == 0 or not self.reader.peek(1):
+            return 0
+        self.reader.skip(1)
+        return self.reader.read(8)
 
-    # Convert .bin file to bitarray to be decoded
+    # Decode the length of the original data after the header flags
+    # for binary data the length is stored plus one, followed by the row of the virtual terminator plus one when the BWT is used
+    def decode_length(self):
+        self.decoded_length = self.reader.read_elias()
+        if self.binary:
+            self.decoded_length -= 1
+            if not self.flags & (FLAG_HUFFMAN | FLAG_STORED):
+                self.primary_index = self.reader.read_elias() - 1
+
+    # Decode the header and data part written with the move-to-front and zero-run stage, returns the BWT string
+    def decode_mtf(self):
+        reader = self.reader
+        alphabet_size = reader.read_elias()
+        # the alphabet in the order the move-to-front list starts with, char_bits bits per character
+        alphabet = [chr(reader.read(self.char_bits)) for _ in range(alphabet_size)]
+        symbol_count = reader.read_elias()
+        code_count = reader.read_elias()
+        code_words = {}
+        for _ in range(code_count):
+            symbol = reader.read_elias() - 1
+            code_words[symbol] = reader.read_bits(reader.read_elias())
+
+        # the data part only holds huffman code words, so bitarray decodes them all in one pass
+        with stage('huffman_decode', self.length >> 3) as timer:
+            symbols = list(islice(self.bit_string[reader.pos:].iterdecode(decodetree(code_words)), symbol_count))
+            timer.output_size = len(symbols)
+        with stage('mtf_decode', len(symbols)) as timer:
+            decoded_data = mtf.decode_runs(symbols, alphabet)
+            timer.output_size = len(decoded_data)
+        return decoded_data
+
+    # Convert .bin file to bitarray to be decoded, the bitarray is a read-only view over the memory mapped file
+    # the map stays open as long as the bitarray uses it
     def file_to_bitarray(self, filename):
-        bit_data = bitarray()  # Create an empty bitarray to store the data
+        # encoded bytes are viewed directly
+        if isinstance(filename, (bytes, bytearray, memoryview)):
+            return bitarray(buffer=filename)
         with open(filename, "rb") as bin_file:
-            bit_data.fromfile(bin_file)  # Read the binary file directly into the bitarray
-        return bit_data
+            # an empty file cannot be memory mapped
+            if os.fstat(bin_file.fileno()).st_size == 0:
+                return bitarray()
+            return bitarray(buffer=mmap.mmap(bin_file.fileno(), 0, access=mmap.ACCESS_READ))
 
     # Decode header part
     def decode_header(self):
-        # decode length of the original data using elias
-        self.decoded_length = self.elias_decoding()
-        # decode the number of unique characters in the original data
-        uniq_chars_count = self.elias_decoding()
+        reader = self.reader
+        self.dictionary = None
+        if self.flags & FLAG_DICTIONARY:
+            self.decode_dictionary()
+            return
+        if not self.flags:
+            # decode length of the original data, the length is already decoded after the flags otherwise
+            self.decoded_length = reader.read_elias()
+        # decode the number of unique characters
+        uniq_chars_count = reader.read_elias()
 
         for _ in range(uniq_chars_count):
-            # get the ascii code (7-bits)
-            ascii_code_char = bitarray()
-            # use for loop to avoid slicing
-            for i in range(7):
-                ascii_code_char += str(self.bit_string[self.curr_pos + i])
-            # convert ascii code to char
-            char = chr(binary_to_decimal(ascii_code_char))  
-            # move pointer to next 7-bits
-            self.curr_pos += 7
+            # get the character code (7 bits, or 8 bits for binary data)
+            char = chr(reader.read(self.char_bits))
             # find length of the huffman code
-            huffman_length = self.elias_decoding()
+            huffman_length = reader.read_elias()
             # get huffman code of the character
-            huffman_code = bitarray()
-            # use for loop to avoid slicing
-            for i in range(huffman_length):
-                huffman_code += str(self.bit_string[self.curr_pos + i])
-            # move pointer based on the computed huffman length
-            self.curr_pos += huffman_length
+            huffman_code = reader.read_bits(huffman_length)
             # insert into the bit path tree based on the decoded huffman code of the character
             self.binary_tree.add_node(char, huffman_code)
+            self.huffman_codes.append((char, huffman_code))
+
+    # Use the code words of the dictionary whose id follows the length, in place of a table in the header
+    # the bit path tree and lookup tables of a dictionary are built by the first file that uses it and shared by the next ones
+    def decode_dictionary(self):
+        self.dictionary = get_dictionary(self.reader.read_elias() - 1)
+        if self.dictionary.decoding is None:
+            for code, code_word in enumerate(self.dictionary.code_words):
+                if code_word is not None:
+                    self.binary_tree.add_node(chr(code), code_word)
+                    self.huffman_codes.append((chr(code), code_word))
+            self.dictionary.decoding = (self.binary_tree, self.huffman_codes, self.build_huffman_table())
+        self.binary_tree, self.huffman_codes, _ = self.dictionary.decoding
+
+    # Build the huffman lookup tables, returns None when the tables cannot be used so the tree is walked instead
+    def build_huffman_table(self):
+        if self.dictionary is not None and self.dictionary.decoding is not None:
+            return self.dictionary.decoding[2]
+        # a single character has an empty code word, which only the tree can handle
+        if not self.huffman_codes or any(len(code) == 0 for _, code in self.huffman_codes):
+            return None
+        table = HuffmanTable(self.huffman_codes)
+        if table.max_length > table.primary_bits + HuffmanTable.MAX_EXTRA_BITS:
+            return None
+        return table
+
+    # Decode data part with the huffman lookup tables
+    def decode_data_table(self):
+        decoded_data = []
+        decoded_length = 0
+        table = self.huffman_table
+        reader = self.reader
+
+        # decode (char, run length) pairs until all the original data is decoded or the bit string runs out
+        while decoded_length < self.decoded_length and reader.pos < self.length - 1:
+            char, bits_used, elias_runlen = table.lookup(reader)
+            reader.skip(bits_used)
+            # decode the elias code to get the run length of the char, unless the lookup already resolved it
+            if elias_runlen == 0:
+                elias_runlen = reader.read_elias()
+            decoded_data.append(char * elias_runlen)
+            decoded_length += elias_runlen
+
+        return "".join(decoded_data)
 
 
     # Decode data part
@@ -106,11 +340,10 @@ class RunLengthDecoder:
         # Iterate the bit path tree until all the data from the remaining bit string is decoded
         while True:
             # Iterate through the bit path tree until reach leaf node
-            current_node = self.binary_tree.get_next_node(current_node, self.bit_string[self.curr_pos])
-            self.curr_pos += 1
+            current_node = self.binary_tree.get_next_node(current_node, self.reader.read(1))
             # if reach leaf node, decode the elias code to get the run length of the char
             if current_node.leaf:
-                elias_runlen = self.elias_decoding()
+                elias_runlen = self.reader.read_elias()
                 # character is repeated based on the run length
                 decoded_data += current_node.char * elias_runlen
                 # reset the current node to the root
@@ -119,76 +352,82 @@ class RunLengthDecoder:
                 if len(decoded_data) == self.decoded_length:
                     return decoded_data
 
-            if self.curr_pos >= self.length - 1:
+            if self.reader.pos >= self.length - 1:
                 return decoded_data
-
-    # Decode elias code, while updating the self.curr_pos pointer
-    def elias_decoding(self):
-        # flag to check if elias code is done
-        elias = True
-        # initialize decoding result to bitarray
-        decode_res = bitarray('0')
-        while elias:
-            # length of next segment to decode
-            next_len = binary_to_decimal(decode_res) + 1
-            decode_res = bitarray()
-
-            for i in range(next_len):
-                if i == 0:
-                    # if the first bit is 1, then this is the last segment to decode
-                    if self.bit_string[self.curr_pos]:
-                        elias = False
-                    else:
-                        # make the first bit '1'
-                        decode_res += bitarray('1')
-                        continue
-                # append the current bit to the decoding result
-                decode_res += bitarray([self.bit_string[self.curr_pos+i]])
-
-            # update curr_pos pointer
-            self.curr_pos += next_len 
-        
-        # return the decoded elias code in decimal number
-        return binary_to_decimal(decode_res) 
     
     # Inverse BWT string using LF-mapping method
-    def inverse_bwt(self):
-        # get the last column
-        L = self.decoded_data
-        
-        frequency = [0] * 91  # store frequency of each character
-        rank = [None] * 91  # store rank of each unique character
-        order = [0] * len(L)  # store order of the same character
-
-        for i in range(len(L)):
-            frequency[ord(L[i]) - 36] += 1
-            # order is calculated based on the frequency of each character at that index
-            order[i] = frequency[ord(L[i]) - 36]
-
-        # calculate rank
-        prev_freq = 0
-        prev_rank = 0
-        for i in range(91):
-            if frequency[i] != 0:
-                rank[i] = prev_rank + prev_freq
-                prev_freq = frequency[i]
-                prev_rank = rank[i]
-
-        # rebuild the string by appending the next character to the front of the string
-        rebuild_string = "$"
-        next_position = 0
-        while len(rebuild_string) < len(L):
-            rebuild_string = L[next_position] + rebuild_string
-            # find the next position by using the current position's rank and order
-            next_position = rank[ord(L[next_position]) - 36] + order[next_position] - 1
-        return rebuild_string
+    # out is a preallocated writable buffer of the decoded length to fill, by default a new one is made and returned as a string,
+    # or as bytes for binary data
+    def inverse_bwt(self, out=None):
+        with stage('inverse_bwt', len(self.decoded_data)):
+            # get the last column as bytes and as an array of character codes over the same buffer
+            last_column = self.decoded_data.encode('latin-1')
+            L = np.frombuffer(last_column, dtype=np.uint8)
+            n = len(L)
+            rebuild_string = bytearray(n) if out is None else out
+            if n == 0:
+                return self.result(rebuild_string, out)
+
+            frequency = np.bincount(L, minlength=256)
+            # LF-mapping: row i of the last column maps to the row of the same character in the first column
+            # a stable sort of the last column lists its rows in the order of the first column, so the j-th row it gives maps to j
+            index_type = np.int32 if n < 2 ** 31 - 1 else np.int64
+            rows = np.argsort(L, kind='stable').astype(index_type, copy=False)
+            lf = np.empty(n + 1 if self.binary else n, dtype=index_type)
+            if self.binary:
+                # the virtual terminator is the first row of the first column, and its row in the last column was left out
+                p = self.primary_index
+                rows[rows >= p] += 1
+                lf[rows] = np.arange(1, n + 1, dtype=index_type)
+            else:
+                lf[rows] = np.arange(n, dtype=index_type)
+            del rows
+            # rows are visited one after the other, a memoryview gives fast scalar access without copying
+            lf = memoryview(lf)
+
+            if self.binary:
+                # put back the row of the virtual terminator, it is never read since the walk stops before reaching it
+                lf[p] = 0
+                last_column = last_column[:p] + bytes(1) + last_column[p:]
+                start = n - 1
+            else:
+                # the string ends with the terminator, the smallest character
+                rebuild_string[n - 1] = int(np.flatnonzero(frequency)[0])
+                start = n - 2
+
+            # fill the preallocated string from back to front
+            next_position = 0
+            for i in range(start, -1, -1):
+                rebuild_string[i] = last_column[next_position]
+                # find the next position by using the current position's rank and order
+                next_position = lf[next_position]
+            return self.result(rebuild_string, out)
+
+    # Convert the rebuilt buffer to the decoded data, a string for text and bytes for binary data
+    # a buffer given by the caller is returned as it is
+    def result(self, rebuild_string, out):
+        if out is not None:
+            return out
+        if self.binary:
+            return bytes(rebuild_string)
+        return rebuild_string.decode('latin-1')
             
             
     # Output the decoded data to a file
     def output(self):
-        with open('q2_decoder_output.txt', "w+") as file:
+        with open(self.output_file, "wb" if self.binary else "w+") as file:
             file.write(self.original_data)
+
+    # Output binary data by rebuilding it straight into the output file, which is sized up front and memory mapped
+    def output_mapped(self):
+        with open(self.output_file, "wb+") as file:
+            # an empty file cannot be memory mapped
+            if self.decoded_length == 0:
+                return
+            file.truncate(self.decoded_length)
+            with mmap.mmap(file.fileno(), self.decoded_length) as mapped:
+                self.inverse_bwt(mapped)
                     
 if __name__ == "__main__":
-    RunLengthDecoder(sys.argv[1])
+    RunLengthDecoder(sys.argv[1], 'q2_decoder_output.txt')
    
\ No newline at end of file
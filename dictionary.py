@@ -0,0 +1,127 @@
+# This file contains the pretrained huffman dictionaries of the compressor, for workloads of many small files
+# A dictionary holds a huffman code word for every byte value, trained offline on the runs of the BWT of a sample corpus
+# A file encoded with RunLengthEncoder(data, dictionary=...) only stores the id of the dictionary in its header instead of
+# its own table of code words (FLAG_DICTIONARY), and RunLengthDecoder looks the id up in the registry of this process
+# The code words are canonical, so a dictionary is stored as the code word length of every byte value
+#
+# Dictionary file layout (big endian):
+#   DICTIONARY_HEADER: DICTIONARY_MAGIC, format version, dictionary id
+#   code word length of every byte value, one byte each, 0 for a byte value without a code word
+#
+# usage:
+#   python dictionary.py train 1 dictionaries/1.bwtd sample1.txt sample2.txt ...
+#   load_directory('dictionaries')
+#   RunLengthEncoder(string, dictionary=1)
+
+import os
+import struct
+import sys
+import numpy as np
+from bitarray.util import int2ba
+
+DICTIONARY_MAGIC = b'BWTD'
+DICTIONARY_VERSION = 1
+DICTIONARY_HEADER = struct.Struct('>4sBI')
+# extension of the dictionary files load_directory picks up
+DICTIONARY_EXTENSION = '.bwtd'
+
+# Compute the canonical code words of the code word lengths, returns a list of bitarray (None where the length is 0)
+# code words are given in order of length and then of byte value, each one the previous plus one, shifted to its length
+def canonical_code_words(lengths):
+    code_words = [None] * len(lengths)
+    code = 0
+    previous = 0
+    for length, symbol in sorted((length, symbol) for symbol, length in enumerate(lengths) if length > 0):
+        code <<= length - previous
+        code_words[symbol] = int2ba(code, length)
+        code += 1
+        previous = length
+    return code_words
+
+class Dictionary:
+    def __init__(self, dictionary_id, lengths, version=DICTIONARY_VERSION):
+        if not 0 <= dictionary_id < 2 ** 32:
+            raise ValueError("dictionary id must fit in 32 bits")
+        self.id = dictionary_id
+        self.version = version
+        # code word length of every byte value, as a numpy array so the size of a file can be computed in one step
+        self.lengths = np.array(lengths, dtype=np.int64)
+        if len(self.lengths) != 256 or self.lengths.min() < 0 or self.lengths.max() > 255:
+            raise ValueError("a dictionary has a code word length from 0 to 255 for every byte value")
+        self.code_words = canonical_code_words(self.lengths.tolist())
+        # decoding structures, built by decoder.py the first time a file uses the dictionary and shared by the next ones
+        self.decoding = None
+
+    # Number of bits the code words of the characters take, for the given count of every byte value
+    # None when a character with a count has no code word
+    def cost(self, counts):
+        if np.any((counts > 0) & (self.lengths == 0)):
+            return None
+        return int((counts * self.lengths).sum())
+
+    # Bytes of the dictionary file
+    def to_bytes(self):
+        return DICTIONARY_HEADER.pack(DICTIONARY_MAGIC, self.version, self.id) + self.lengths.astype(np.uint8).tobytes()
+
+    # Read a dictionary from the bytes of its file
+    @staticmethod
+    def from_bytes(data):
+        if len(data) != DICTIONARY_HEADER.size + 256:
+            raise ValueError("not a dictionary file")
+        magic, version, dictionary_id = DICTIONARY_HEADER.unpack_from(data)
+        if magic != DICTIONARY_MAGIC:
+            raise ValueError("not a dictionary file")
+        if version > DICTIONARY_VERSION:
+            raise ValueError("dictionary format version %d is newer than this version (%d)" % (version, DICTIONARY_VERSION))
+        return Dictionary(dictionary_id, np.frombuffer(data, dtype=np.uint8, offset=DICTIONARY_HEADER.size), version)
+
+    # Write the dictionary file
+    def save(self, filename):
+        with open(filename, "wb") as file:
+            file.write(self.to_bytes())
+
+# Read a dictionary file
+def load(filename):
+    with open(filename, "rb") as file:
+        return Dictionary.from_bytes(file.read())
+
+# dictionaries of this process by id, the decoder only knows the dictionaries registered here
+registry = {}
+
+# Add the dictionary to the registry, replacing any with the same id
+def register(dictionary):
+    registry[dictionary.id] = dictionary
+    return dictionary
+
+# Read every dictionary file in the directory and register them, returns the dictionaries
+def load_directory(directory):
+    dictionaries = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(DICTIONARY_EXTENSION):
+            dictionaries.append(register(load(os.path.join(directory, name))))
+    return dictionaries
+
+# Get the registered dictionary of the id, or the given dictionary itself
+def get_dictionary(dictionary):
+    if isinstance(dictionary, Dictionary):
+        return dictionary
+    if dictionary not in registry:
+        raise ValueError("unknown dictionary %r" % (dictionary,))
+    return registry[dictionary]
+
+if __name__ == "__main__":
+    # usage: python dictionary.py train id output samples...
+    #        python dictionary.py show dictionary_file
+    from encoder import train_dictionary
+    action = sys.argv[1]
+    if action == 'train':
+        samples = []
+        for name in sys.argv[4:]:
+            with open(name, "rb") as file:
+                samples.append(file.read())
+        train_dictionary(samples, int(sys.argv[2])).save(sys.argv[3])
+    else:
+        dictionary = load(sys.argv[2])
+        print("dictionary %d (format version %d)" % (dictionary.id, dictionary.version))
+        for symbol in np.flatnonzero(dictionary.lengths).tolist():
+            print("%3d %s" % (symbol, dictionary.code_words[symbol].to01()))
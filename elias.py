@@ -0,0 +1,51 @@
+# This file contains the Elias omega codes shared by the encoders, the codes are read back by BitReader.read_elias in bitio.py
+# A code is made of groups: every group but the last holds the length of the next group minus one with its first bit changed to 0,
+# the last group is the binary number itself and starts with 1. The code of 1 is the single bit 1
+
+import numpy as np
+from bitarray import frozenbitarray
+from bitarray.util import ba2int
+
+# codes of the numbers below this value are precomputed once, run lengths and code lengths are almost always small
+TABLE_SIZE = 1 << 12
+
+# Build the elias omega code of a positive number
+def build(num):
+    groups = [format(num, 'b')]
+    length = len(groups[0])
+    # prepend the length of the previous group minus one, with its first bit changed to 0, until the group is 1 bit long
+    while length != 1:
+        group = format(length - 1, 'b')
+        groups.append('0' + group[1:])
+        length = len(group)
+    return frozenbitarray(''.join(reversed(groups)))
+
+# precomputed codes, index 0 is unused since only positive numbers have a code
+TABLE = [None] + [build(num) for num in range(1, TABLE_SIZE)]
+
+# length in bits of each precomputed code
+TABLE_LENGTHS = np.array([0] + [len(code) for code in TABLE[1:]], dtype=np.int64)
+# (code read as a number, length in bits) of each precomputed code, for writers that work on numbers
+TABLE_VALUES = [None] + [(ba2int(code), len(code)) for code in TABLE[1:]]
+
+# Get the elias omega code of a positive number, the code is immutable so it can be shared
+def encode(num):
+    if num < TABLE_SIZE:
+        return TABLE[num]
+    return build(num)
+
+# Get the elias omega code of a positive number as (code read as a number, length in bits)
+def encode_value(num):
+    if num < TABLE_SIZE:
+        return TABLE_VALUES[num]
+    code = build(num)
+    return ba2int(code), len(code)
+
+# Get the length in bits of the elias omega code of every positive number in the numpy array
+def lengths(nums):
+    nums = np.asarray(nums, dtype=np.int64)
+    result = TABLE_LENGTHS[np.minimum(nums, TABLE_SIZE - 1)]
+    # numbers past the table are rare, so their codes are built one by one
+    for i in np.flatnonzero(nums >= TABLE_SIZE):
+        result[i] = len(build(int(nums[i])))
+    return result
@@ -1,22 +1,61 @@
 import heapq
+import mmap
+import os
 import sys
+import numpy as np
+import ans
+import elias
+import fmindex
+import mtf
+from bitio import BitWriter
+from dictionary import Dictionary, get_dictionary
 from helper import *
+from instrument import stage
+from suffix_array import ENGINE_MEMORY, build_suffix_array, engine_memory
 from bitarray import bitarray
 
-# Convert the input string to BWT, by using the suffix array computed from ukkonen suffix tree
+# size of the sample the adaptive mode runs the BWT pipeline on, taken as a few evenly spaced windows
+ADAPTIVE_SAMPLE_SIZE = 64 * 1024
+ADAPTIVE_WINDOWS = 4
+# a costlier pipeline must give less than this fraction of the size of a cheaper one to be picked
+ADAPTIVE_MARGIN = 0.95
+# peak bytes per input character the encoder allocates past the suffix array: the BWT, the runs, the code words and the output
+ENCODE_MEMORY_PER_CHAR = 16
+# peak bytes the encoder allocates whatever the length of the input
+ENCODE_MEMORY_BASE = 1 << 20
+
+# Convert the input string to BWT, by using the suffix array computed by the chosen engine in suffix_array.py
+# method is one of 'tree' (ukkonen suffix tree), 'sais', 'doubling' or 'auto' to pick one based on the input size
+# the input is either a string ending with the '$' terminator, or bytes-like data (bytes, memoryview, ...) of any byte values,
+# which gets a virtual terminator that is left out of the BWT, its row is kept in primary_index instead like bzip2 does
 class BWTConverter:
-    def __init__(self, string):
+    def __init__(self, string, method='auto'):
         self.string = string
-        self.implicitST = SuffixTree(string)
-        self.suffix_array = self.implicitST.suffix_array
+        with stage('suffix_array', len(string)):
+            self.suffix_array = build_suffix_array(string, method)
+        self.primary_index = None
 
-    # Convert the suffix array to BWT string
-    def convert(self):
-        self.result = ""
-        for i in range(len(self.suffix_array)):
-            self.result += self.string[self.suffix_array[i]-1]
+    # Convert the suffix array to BWT as a numpy array of character codes
+    def convert_array(self):
+        with stage('bwt', len(self.string)) as timer:
+            if isinstance(self.string, str):
+                codes = np.frombuffer(self.string.encode('latin-1'), dtype=np.uint8)
+                # the suffix starting at 0 gives index -1, which is the last character
+                self.result = codes[np.asarray(self.suffix_array) - 1]
+            else:
+                codes = np.frombuffer(self.string, dtype=np.uint8)
+                suffix_array = np.asarray(self.suffix_array)
+                # the character before the suffix starting at 0 is the virtual terminator, its row is dropped
+                self.primary_index = int(np.flatnonzero(suffix_array == 0)[0])
+                self.result = codes[np.delete(suffix_array, self.primary_index) - 1]
+            timer.output_size = len(self.result)
         return self.result
 
+    # Convert the suffix array to BWT string, or bytes for bytes-like input
+    def convert(self):
+        result = self.convert_array().tobytes()
+        return result.decode('latin-1') if isinstance(self.string, str) else result
+
 # HeapNode class to represent node when constructing heap for huffman code
 class HeapNode:
     def __init__(self, char, frequency, left_child=None, right_child=None): 
@@ -24,167 +63,416 @@ class HeapNode:
         self.frequency = frequency 
         self.left_child = left_child  # Store HeapNode object
         self.right_child = right_child  # Store HeapNode object
-        # 0 for left child, 1 for right child
-        self.direction = '' 
   
     def __lt__(self, nxt): 
         return self.frequency < nxt.frequency 
+
+# Compute the huffman code word of every symbol from a dict of symbol frequencies, returns a dict of symbol to bitarray
+# a single symbol gets the code word 0 so every code word has at least one bit
+def huffman_code_words(frequencies):
+    heap = []
+    for symbol in sorted(frequencies):
+        heapq.heappush(heap, HeapNode(symbol, frequencies[symbol]))
+    if len(heap) == 1:
+        return {heap[0].char: bitarray('0')}
+    while len(heap) > 1:
+        left = heapq.heappop(heap)
+        right = heapq.heappop(heap)
+        heapq.heappush(heap, HeapNode(None, left.frequency + right.frequency, left, right))
+
+    # walk the tree with a stack, appending 0 for the left child and 1 for the right child
+    code_words = {}
+    stack = [(heap[0], '')]
+    while stack:
+        node, code = stack.pop()
+        if node.left_child is None:
+            code_words[node.char] = bitarray(code)
+        else:
+            stack.append((node.left_child, code + '0'))
+            stack.append((node.right_child, code + '1'))
+    return code_words
     
 ### MAIN CLASS ###
 # Encode the input string using run-length encoding
+# output_file is the file the encoded data is written to, by default the result is only kept in memory
+# use_mtf adds the move-to-front and zero-run stage from mtf.py between the BWT and huffman coding, it is recorded in the header flags
+# a string must end with the '$' terminator, bytes-like input is coded over the full 0-255 alphabet and sets FLAG_BYTES
+# fm_index appends the FM-index section from fmindex.py, so the output can be searched without decompressing it
+# adaptive samples the input and picks the cheapest worthwhile pipeline: the BWT, huffman code words only, or the input stored
+# as it is, and it never gives more than the stored input. The pipeline is kept in self.pipeline and recorded in the header flags
+# max_memory is a budget in bytes: the peak memory is estimated up front (self.memory_estimate), and when the chosen suffix
+# array engine would not fit, the leanest one that does is used instead, MemoryError is raised when none does
+# the estimate and the measured peak are both reported to the hooks of instrument.py in the event of the encode stage
+# dictionary is a pretrained huffman dictionary from dictionary.py, or its id in the registry: the runs are coded with its
+# code words and the header only holds its id (FLAG_DICTIONARY), unless a table of their own is smaller, see dictionary_fits
+# entropy is the backend of the runs of the BWT: 'huffman' code words with elias run lengths, or the tANS models of ans.py
+# ('ans', FLAG_ANS), which only codes the runs so it cannot be combined with the move-to-front stage, the FM-index or a dictionary
 class RunLengthEncoder:
-    def __init__(self, string):
-        # compute the BWT of the input string
-        self.string = BWTConverter(string).convert()
-        self.length = len(self.string)
-        # store the frequency of each unique characters in self.string
-        self.uniq_chars = [None] * 91
-        # store the huffman code of each unique characters in self.string
-        self.huffman_heap = [None] * 91
-        # store the elias code of length of huffman code word
-        self.huffman_length = [None] * 91
-        # get frequency of each unique characters in self.string
-        self.get_frequency()
-        # compute huffman word core for each unique characters populated to self.uniqueChar
-        self.get_huffman_code_word()
-        # encode header and data part
-        self.res = self.encode_header() + self.encode_data()
+    def __init__(self, string, method='auto', output_file=None, use_mtf=False, fm_index=False, adaptive=False, max_memory=None,
+                 dictionary=None, entropy='huffman'):
+        self.output_file = output_file
+        self.binary = not isinstance(string, str)
+        # number of bits each character takes in the header
+        self.char_bits = 8 if self.binary else 7
+        if not self.binary and not string.isascii():
+            raise ValueError("text input must be ascii, code other data as bytes")
+        if fm_index and use_mtf:
+            raise ValueError("the FM-index does not support the move-to-front stage")
+        if fm_index and adaptive:
+            raise ValueError("the FM-index needs the BWT pipeline, it cannot be combined with the adaptive mode")
+        if dictionary is not None and use_mtf:
+            raise ValueError("dictionaries do not support the move-to-front stage")
+        if entropy not in ('huffman', 'ans'):
+            raise ValueError("unknown entropy backend %r" % (entropy,))
+        if entropy == 'ans' and (use_mtf or fm_index or dictionary is not None):
+            raise ValueError("the tANS backend cannot be combined with the move-to-front stage, the FM-index or a dictionary")
+        self.entropy = entropy
+        self.dictionary = None if dictionary is None else get_dictionary(dictionary)
+        # empty input has no runs to index
+        fm_index = fm_index and len(string) > 0
+        self.flags = (FLAG_MTF if use_mtf else 0) | (FLAG_BYTES if self.binary else 0) | (FLAG_FM_INDEX if fm_index else 0)
+        self.index = None
+        self.primary_index = None
+        if max_memory is not None:
+            method = fit_method(len(string), max_memory, method)
+        self.method = method
+        self.memory_estimate = estimate_memory(len(string), method)
+        with stage('encode', len(string)) as timer:
+            timer.estimate_bytes = self.memory_estimate
+            if adaptive:
+                with stage('adaptive', len(string)):
+                    self.pipeline = self.choose_pipeline(string, method, use_mtf)
+            else:
+                self.pipeline = 'bwt'
+            if self.pipeline == 'bwt':
+                self.encode_bwt(string, method, use_mtf, fm_index)
+            elif self.pipeline == 'huffman':
+                self.encode_huffman(string)
+            # the stored input is the fallback of the adaptive mode when the chosen pipeline does not pay off
+            if self.pipeline == 'stored' or (adaptive and len(self.res) > (len(string) + 1) << 3):
+                stored = self.encode_stored(string)
+                if self.pipeline == 'stored' or len(stored) < len(self.res):
+                    self.pipeline = 'stored'
+                    self.res = stored
+            timer.output_size = (len(self.res) + 7) >> 3
         # output to file
-        self.output()
-
-    # Do elias encoding on given decimal number
-    def elias_encoding(self, decimal_num):
-        # Convert decimal number to binary
-        elias_code = decimal_to_binary(decimal_num)
-        length = len(elias_code)
-        # Repeat the process until the length of the binary number is 1
-        while length != 1:
-            length -= 1
-            encoded_bitarray = bitarray(format(length, 'b'))
-            # Change the first bit to 0
-            encoded_bitarray[0] = 0
-            # Add the binary number in front of previous computed elias code
-            elias_code = encoded_bitarray + elias_code
-            length = len(encoded_bitarray)
-            if length == 1:
-                return elias_code
-        return elias_code
-
-
-    # Calculate the frequency of each unique characters in self.string and stores it in respective ascii index
+        if self.output_file is not None:
+            self.output()
+
+    # Encode with the full pipeline: BWT, run-length and huffman coding
+    def encode_bwt(self, string, method, use_mtf, fm_index):
+        # compute the BWT of the input string, as an array of character codes
+        converter = BWTConverter(string, method)
+        self.bwt = converter.convert_array()
+        self.primary_index = converter.primary_index
+        self.length = len(self.bwt)
+        if self.length == 0:
+            # empty binary input only has the start of the header
+            self.res = self.encode_flags().to_bitarray()
+        elif use_mtf:
+            self.res = self.encode_mtf()
+        else:
+            self.encode_runs()
+        if fm_index:
+            with stage('fm_index', self.length):
+                self.index = fmindex.build_index(self, converter.suffix_array)
+
+    # Encode the runs of the BWT with huffman code words for the characters and elias codes for the run lengths
+    def encode_runs(self):
+        run_chars, run_lengths = self.run_length_encoding()
+        if self.entropy == 'ans':
+            self.flags |= FLAG_ANS
+            self.res = self.encode_ans(run_chars, run_lengths)
+            return
+        if self.dictionary is not None and self.dictionary_fits(run_chars):
+            # the code words come from the dictionary, so no table is built or written
+            self.flags |= FLAG_DICTIONARY
+            self.huffman_heap = self.dictionary.code_words
+        else:
+            self.dictionary = None
+            self.build_huffman_codes()
+        # encode header and data part
+        self.res = self.encode(run_chars, run_lengths)
+
+    # Encode the runs with the tANS backend, the models of the characters and the run lengths follow the start of the header
+    def encode_ans(self, run_chars, run_lengths):
+        with stage('emit', len(run_chars)) as timer:
+            writer = ans.encode_runs(self.encode_flags(), run_chars, run_lengths, self.char_bits)
+            timer.output_size = (len(writer) + 7) >> 3
+        return writer.to_bitarray()
+
+    # Whether the dictionary codes the characters of the runs in fewer bits than a table of their own, header included
+    # the size with a table of their own is estimated from the entropy of the characters, which huffman code words nearly reach
+    def dictionary_fits(self, run_chars):
+        counts = np.bincount(run_chars, minlength=256)
+        dictionary_bits = self.dictionary.cost(counts)
+        if dictionary_bits is None:
+            return False
+        present = counts[counts > 0]
+        # every code word takes at least one bit
+        code_lengths = np.maximum(-np.log2(present / present.sum()), 1)
+        table_bits = len(present) * self.char_bits + np.ceil(code_lengths).sum() + elias.lengths(np.ceil(code_lengths)).sum()
+        return dictionary_bits <= (present * code_lengths).sum() + table_bits
+
+    # Compute the huffman code word of every unique character in self.bwt
+    def build_huffman_codes(self):
+        # store the frequency of each unique characters in self.bwt, indexed by character code
+        self.uniq_chars = [None] * 256
+        # store the huffman code of each unique characters in self.bwt
+        self.huffman_heap = [None] * 256
+        # store the elias code of length of huffman code word
+        self.huffman_length = [None] * 256
+        with stage('huffman', self.length):
+            # get frequency of each unique characters in self.bwt
+            self.get_frequency()
+            # compute huffman word core for each unique characters populated to self.uniqueChar
+            self.get_huffman_code_word()
+
+    # Encode with huffman code words of the input characters only, the header is the same as the one of the BWT pipeline
+    def encode_huffman(self, string):
+        self.flags = (self.flags & FLAG_BYTES) | FLAG_HUFFMAN
+        # the huffman pipeline codes the input itself in place of the BWT, copied so no view of the caller's buffer is kept
+        self.bwt = np.array(input_codes(string))
+        self.length = len(self.bwt)
+        self.build_huffman_codes()
+        with stage('emit', self.length) as timer:
+            writer = self.encode_header()
+            code_words = {code: self.huffman_heap[code] for code in range(256) if self.huffman_heap[code] is not None}
+            writer.write_codes(code_words, self.bwt.tolist())
+            timer.output_size = (len(writer) + 7) >> 3
+        self.res = writer.to_bitarray()
+
+    # Encode the input as it is, after the start of the header the input starts at the next byte, returns the bitarray
+    def encode_stored(self, string):
+        self.flags = (self.flags & FLAG_BYTES) | FLAG_STORED
+        self.primary_index = None
+        self.length = len(string)
+        writer = self.encode_flags()
+        writer.align()
+        writer.write_bytes(input_codes(string).tobytes())
+        return writer.to_bitarray()
+
+    # Pick the pipeline of the adaptive mode, returns 'bwt', 'huffman' or 'stored'
+    # the size of the huffman pipeline is computed from the frequencies of the whole input, and the size of the BWT pipeline
+    # is estimated from the ratio it gets on a sample. A costlier pipeline is only picked when it is ADAPTIVE_MARGIN smaller
+    def choose_pipeline(self, string, method, use_mtf):
+        codes = input_codes(string)
+        n = len(codes)
+        if n == 0:
+            return 'bwt'
+        frequency = np.bincount(codes, minlength=256)
+        code_words = huffman_code_words({code: int(frequency[code]) for code in np.flatnonzero(frequency).tolist()})
+        huffman_bits = sum(int(frequency[code]) * len(code_word) + self.char_bits + len(elias.encode(len(code_word)))
+                           + len(code_word) for code, code_word in code_words.items())
+        stored_bits = n << 3
+
+        # evenly spaced windows of the input, for text the terminator is left out of the windows and added at the end
+        body = codes[:-1] if not self.binary else codes
+        if len(body) <= ADAPTIVE_SAMPLE_SIZE:
+            sample = body
+        else:
+            window = ADAPTIVE_SAMPLE_SIZE // ADAPTIVE_WINDOWS
+            starts = np.linspace(0, len(body) - window, ADAPTIVE_WINDOWS).astype(np.int64)
+            sample = np.concatenate([body[start:start + window] for start in starts])
+        sample = sample.tobytes()
+        if not self.binary:
+            sample = sample.decode('latin-1') + '$'
+        sample_bits = len(RunLengthEncoder(sample, method, use_mtf=use_mtf, dictionary=self.dictionary, entropy=self.entropy).res)
+        bwt_bits = sample_bits * n / max(len(sample), 1)
+
+        if bwt_bits < min(huffman_bits, stored_bits) * ADAPTIVE_MARGIN:
+            return 'bwt'
+        if huffman_bits < stored_bits * ADAPTIVE_MARGIN:
+            return 'huffman'
+        return 'stored'
+
+    # Calculate the frequency of each unique characters in self.bwt and stores it in respective character code index
     def get_frequency(self):
-        for i in range(self.length):
-            ascii_val = char_to_ascii(self.string[i])
-            if self.uniq_chars[ascii_val] is not None:
-                self.uniq_chars[ascii_val] += 1
-            else:
-                self.uniq_chars[ascii_val] = 1
+        frequency = np.bincount(self.bwt, minlength=256)
+        for code in np.flatnonzero(frequency):
+            self.uniq_chars[code] = int(frequency[code])
+
     # Handles the computation of huffman code word for each unique characters
     def get_huffman_code_word(self):
-        # build heap for huffman code, by calculating the frequency of each unique characters
-        heap = self.build_huffman_heap()
-        # calculate huffman code by passing the root node of the tree as parameter
-        self.compute_huffman_code(heap[0])
-
-    # Populate heap by calculating the frequency of unique characters and combining them to form a tree
-    def build_huffman_heap(self):
-        # heap list store the HeapNode object, HeapNode object stores info such as left and right child
-        heap = []
-        for i in range(91):
-            if self.uniq_chars[i] is not None:
-                # push frequency and character
-                heapq.heappush(heap, HeapNode(ascii_to_char(i), self.uniq_chars[i]))
-        while len(heap) > 1:
-            # extract min
-            left = heapq.heappop(heap)
-            right = heapq.heappop(heap)
-            left.direction = 0
-            right.direction = 1
-            # combine the two min frequency nodes to form a new node, push back to heap
-            new_node = HeapNode(left.char + right.char, left.frequency + right.frequency, left, right)
-            heapq.heappush(heap, new_node)
-        return heap
-    
-    # Calculate the huffman code word for each unique characters by calling this recursive function
-    def compute_huffman_code(self, node, val = ''):
-        updated_val = val + str(node.direction) 
-  
-        # the process is repeated until leaf node is reached
-        if(node.left_child): 
-            self.compute_huffman_code(node.left_child, updated_val)
-        if(node.right_child): 
-            self.compute_huffman_code(node.right_child, updated_val)
-  
-        # if leaf node, add the huffman code word and length to the respective list
-        if(not node.left_child and not node.right_child): 
-            self.huffman_heap[char_to_ascii(node.char)] = bitarray(updated_val)
+        code_words = huffman_code_words({i: self.uniq_chars[i] for i in range(256) if self.uniq_chars[i] is not None})
+        for code, code_word in code_words.items():
+            self.huffman_heap[code] = code_word
             # encode the length of huffman code word using elias encoding, store it in huffman_length list
-            self.huffman_length[char_to_ascii(node.char)] = self.elias_encoding(len(updated_val))
-        return self.huffman_heap
+            self.huffman_length[code] = elias.encode(len(code_word))
+
+    # Encode the header and data part into a single bitarray
+    def encode(self, run_chars, run_lengths):
+        with stage('emit', len(run_chars)) as timer:
+            writer = self.encode_header()
+            self.encode_data(writer, run_chars, run_lengths)
+            timer.output_size = (len(writer) + 7) >> 3
+        return writer.to_bitarray()
+
+    # Encode the start of the header, which is the length of the string for the original header without flags, returns the BitWriter
+    # with flags, the length of binary input is stored plus one so it can be 0, followed by the primary index plus one for the BWT
+    def encode_flags(self):
+        writer = BitWriter()
+        if self.flags == 0:
+            # the elias code of a length of 1 is the single bit 1, which reads as the start of a header with flags,
+            # so it goes after the start of a header with no flags set, which the decoder reads like the original header
+            if self.length == 1:
+                writer.write(1, 1)
+                writer.write(0, 8)
+            writer.write_elias(self.length)
+            return writer
+        # a header with flags starts with a 1 bit followed by the flags in 8 bits
+        writer.write(1, 1)
+        writer.write(self.flags, 8)
+        if self.binary:
+            writer.write_elias(self.length + 1)
+            if self.primary_index is not None:
+                writer.write_elias(self.primary_index + 1)
+        else:
+            writer.write_elias(self.length)
+        return writer
 
-    # Encode header part
+    # Encode header part, returns the BitWriter
     def encode_header(self):
-        # encode the length of the string using elias encoding
-        encoded_bitarray = self.elias_encoding(self.length)
+        # encode the flags and the length of the string using elias encoding
+        writer = self.encode_flags()
+        if self.flags & FLAG_DICTIONARY:
+            # the code words are the ones of the dictionary, only its id is stored, plus one as elias codes start at 1
+            writer.write_elias(self.dictionary.id + 1)
+            return writer
         # encode the total number of unique characters
         total_uniq_chars = sum(x is not None for x in self.uniq_chars)
-        uniq_chars_count = self.elias_encoding(total_uniq_chars)
-        encoded_bitarray += uniq_chars_count
+        writer.write_elias(total_uniq_chars)
 
-        # for each unique characters, append the ASCII value of each unique characters, huffman code word length and huffman code word in order
-        for i in range(91):
+        # for each unique characters, append the character code of each unique characters, huffman code word length and huffman code word in order
+        for i in range(256):
             if self.uniq_chars[i] is not None:
-                encoded_bitarray += char_to_binary(ascii_to_char(i)) + self.huffman_length[i] + self.huffman_heap[i]
-
-        return encoded_bitarray
-
-    # Encode the data part
-    def encode_data(self):
-        # get the run-length encoding of the input string to be encoded
-        encoded_tuples = self.run_length_encoding()
-        # initialise the bitarray to store the encoded data
-        encoded_bitarray = bitarray()
-        
-        # for each character and its run length, append the huffman code word and elias code of the run length to the bitarray
-        for char, run_length in encoded_tuples:
-            huffman = self.huffman_heap[char_to_ascii(char)]
-            elias = self.elias_encoding(run_length)
-            encoded_bitarray += huffman + elias
-
-        return encoded_bitarray
+                writer.write(i, self.char_bits)
+                writer.write_bits(self.huffman_length[i])
+                writer.write_bits(self.huffman_heap[i])
+
+        return writer
+
+    # Encode the data part, appending it to the BitWriter
+    def encode_data(self, writer, run_chars, run_lengths):
+        huffman_codes = self.huffman_heap
+        # every distinct (character, run length) pair gets the huffman code word of the character followed by the elias code of the run length, built once
+        pairs, pair_index = np.unique(run_lengths * 256 + run_chars, return_inverse=True)
+        code_words = {}
+        for i, pair in enumerate(pairs.tolist()):
+            code_words[i] = huffman_codes[pair & 255] + elias.encode(pair >> 8)
+        # write the code word of every run in a single pass
+        writer.write_codes(code_words, pair_index.tolist())
+        return writer
     
-    # Perform run-length encoding on the bwt string
+    # Encode with the move-to-front and zero-run stage, after the start of the header from encode_flags the header holds
+    # the alphabet size, the alphabet (in order), the number of symbols in the data part,
+    # the number of symbols with a code word and (symbol + 1, code word length, code word) of each, every number elias encoded
+    def encode_mtf(self):
+        run_chars, run_lengths = self.run_length_encoding()
+        alphabet = np.flatnonzero(np.bincount(self.bwt, minlength=256)).tolist()
+        with stage('mtf', len(run_chars)) as timer:
+            symbols = mtf.encode_runs(run_chars.tolist(), run_lengths.tolist(), alphabet)
+            timer.output_size = len(symbols)
+        with stage('huffman', len(symbols)):
+            frequency = np.bincount(symbols)
+            code_words = huffman_code_words({symbol: int(frequency[symbol]) for symbol in np.flatnonzero(frequency).tolist()})
+
+        with stage('emit', len(symbols)) as timer:
+            writer = self.encode_flags()
+            writer.write_elias(len(alphabet))
+            for code in alphabet:
+                writer.write(code, self.char_bits)
+            writer.write_elias(len(symbols))
+            writer.write_elias(len(code_words))
+            for symbol in sorted(code_words):
+                writer.write_elias(symbol + 1)
+                writer.write_elias(len(code_words[symbol]))
+                writer.write_bits(code_words[symbol])
+
+            # the data part is the huffman code word of every symbol
+            writer.write_codes(code_words, symbols.tolist())
+            timer.output_size = (len(writer) + 7) >> 3
+        return writer.to_bitarray()
+
+    # Perform run-length encoding on the bwt, returns the array of characters and the array of their run lengths
     def run_length_encoding(self):
-        encoded_tuples = [] # list of tuples containing (character, run_length)
-        current_char = None
-        current_run_length = 0
-
-        # iterate through the bwt string, if the current character is the same as the previous character, increment the run length
-        for char in self.string:
-            if char == current_char:
-                current_run_length += 1
-            # if the current character is different from the previous character, append the previous character and its run length to the list
-            else:
-                if current_char is not None:
-                    encoded_tuples.append((current_char, current_run_length))
-                current_char = char
-                current_run_length = 1
-        
-        encoded_tuples.append((current_char, current_run_length))
-        return encoded_tuples
+        with stage('run_length', self.length) as timer:
+            # a run starts at the first position and wherever the character differs from the previous one
+            starts = np.flatnonzero(np.concatenate(([True], self.bwt[1:] != self.bwt[:-1])))
+            run_lengths = np.diff(np.append(starts, self.length))
+            timer.output_size = len(starts)
+        return self.bwt[starts], run_lengths
+
+    # Change bits to bytes so that the encoded string a factor of 8
+    def to_bytes(self):
+        payload = self.res.tobytes()
+        if self.index is None:
+            return payload
+        return payload + self.index + fmindex.index_trailer(len(payload))
 
     # Output the encoded string to a binary file
     def output(self):
-        # Change bits to bytes so that the encoded string a factor of 8
-        bytes_data = self.res.tobytes()
         # write the encoded string to a binary file
-        with open('q2_encoder_output.bin', "wb") as file:
-            file.write(bytes_data)
+        with open(self.output_file, "wb") as file:
+            file.write(self.to_bytes())
+
+# Get the character codes of the input as a numpy array, a string is converted with latin-1 and bytes-like input is used as it is
+def input_codes(string):
+    if isinstance(string, str):
+        return np.frombuffer(string.encode('latin-1'), dtype=np.uint8)
+    return np.frombuffer(string, dtype=np.uint8)
+
+# Train a huffman dictionary on the samples, strings ending with the '$' terminator or bytes-like data, see dictionary.py
+# its code words are built from the number of runs of every character in the BWT of the samples, and every byte value
+# gets a code word, the ones never seen with the count of 1, so any data can still be coded with the dictionary
+def train_dictionary(samples, dictionary_id, method='auto'):
+    counts = np.zeros(256, dtype=np.int64)
+    for sample in samples:
+        bwt = BWTConverter(sample, method).convert_array()
+        if len(bwt) > 0:
+            starts = np.flatnonzero(np.concatenate(([True], bwt[1:] != bwt[:-1])))
+            counts += np.bincount(bwt[starts], minlength=256)
+    code_words = huffman_code_words({symbol: count + 1 for symbol, count in enumerate(counts.tolist())})
+    return Dictionary(dictionary_id, [len(code_words[symbol]) for symbol in range(256)])
+
+# Estimate the peak memory in bytes of encoding length characters with the suffix array engine
+def estimate_memory(length, method='auto'):
+    return ENCODE_MEMORY_BASE + ENCODE_MEMORY_PER_CHAR * length + engine_memory(length, method)
+
+# Pick the suffix array engine to encode length characters within max_memory bytes: the requested one when it fits,
+# otherwise the leanest one that does. Raises MemoryError when none does
+def fit_method(length, max_memory, method='auto'):
+    if estimate_memory(length, method) <= max_memory:
+        return method
+    leanest = min(ENGINE_MEMORY, key=ENGINE_MEMORY.get)
+    if estimate_memory(length, leanest) <= max_memory:
+        return leanest
+    raise MemoryError("encoding %d characters needs about %d bytes, over the budget of %d bytes"
+                      % (length, estimate_memory(length, leanest), max_memory))
+
+# Longest input the leanest suffix array engine can encode within max_memory bytes
+def max_encode_length(max_memory):
+    per_char = ENCODE_MEMORY_PER_CHAR + min(ENGINE_MEMORY.values())
+    # engine_memory counts one more character for the terminator
+    return max(0, (max_memory - ENCODE_MEMORY_BASE) // per_char - 1)
+
+# Encode any file as binary data, the file is read through a memory map so it is never copied into a python object
+# options are passed to RunLengthEncoder
+def encode_file(filename, output_file=None, **options):
+    with open(filename, "rb") as file:
+        # an empty file cannot be memory mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return RunLengthEncoder(b'', output_file=output_file, **options)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as data:
+                return RunLengthEncoder(data, output_file=output_file, **options)
 
 if __name__ == "__main__":
     filename = sys.argv[1]
+    # optional suffix array engine: tree, sais, doubling or auto
+    method = sys.argv[2] if len(sys.argv) > 2 else 'auto'
     with open(filename, "r") as file:
         string = file.read()
     if string[-1] != '$':
         string += '$'
-    RunLengthEncoder(string)
+    RunLengthEncoder(string, method, output_file='q2_encoder_output.bin')
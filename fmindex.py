@@ -0,0 +1,267 @@
+# This file contains the FM-index mode of the compressor, which answers count and locate queries on a compressed file
+# without decompressing it
+# RunLengthEncoder(string, fm_index=True) appends an index section after the run-length payload and sets FLAG_FM_INDEX.
+# The section holds occurrence checkpoints: every checkpoint_runs runs, the row where the run starts,
+# the bit position of its code word and the number of times every character appears in the BWT before it.
+# It also holds a sampled suffix array: the row of every suffix that starts at a multiple of sa_sample, with its position.
+# A query decodes at most checkpoint_runs runs per step from the nearest checkpoint, so count takes time proportional to the
+# pattern length, and locate takes up to sa_sample more steps per occurrence. The runs between two checkpoints are decoded
+# once and cached, so the steps of locate, which keep landing in the same intervals, are mostly lookups in the cached runs.
+# RunLengthDecoder skips the section.
+#
+# Section layout (big endian), written after the bytes of the payload:
+#   INDEX_HEADER: alphabet size, checkpoint_runs, sa_sample, number of checkpoints, number of samples, bytes per number
+#   alphabet (one byte per character), total count of every character
+#   checkpoint rows, checkpoint bit positions, checkpoint counts (one row of alphabet size numbers per checkpoint)
+#   sample rows, sample positions
+#   INDEX_TRAILER: offset of the section in the file, INDEX_MAGIC
+
+import bisect
+import struct
+import numpy as np
+from collections import OrderedDict
+import elias
+from bitio import BitReader
+from decoder import BinaryTree, RunLengthDecoder
+from helper import FLAG_BYTES, FLAG_FM_INDEX, FLAG_MTF
+
+INDEX_MAGIC = b'BWTF'
+INDEX_HEADER = struct.Struct('>IIIQQB')
+INDEX_TRAILER = struct.Struct('>Q4s')
+DEFAULT_CHECKPOINT_RUNS = 1024
+DEFAULT_SA_SAMPLE = 128
+# most decoded checkpoint intervals an FMIndex keeps, the LF steps of locate often come back to the same intervals
+INTERVAL_CACHE_SIZE = 256
+
+# Build the index section of the encoder, which must have coded the runs without the move-to-front stage
+# suffix_array is the suffix array the BWT of the encoder was built from
+def build_index(encoder, suffix_array, checkpoint_runs=DEFAULT_CHECKPOINT_RUNS, sa_sample=DEFAULT_SA_SAMPLE):
+    if checkpoint_runs <= 0 or sa_sample <= 0:
+        raise ValueError("checkpoint_runs and sa_sample must be positive")
+    run_chars, run_lengths = encoder.run_length_encoding()
+    run_starts = np.cumsum(run_lengths) - run_lengths
+    # bit position of the code word of every run, the data part starts right after the header
+    huffman_lengths = np.array([0 if code is None else len(code) for code in encoder.huffman_heap], dtype=np.int64)
+    code_lengths = huffman_lengths[run_chars] + elias.lengths(run_lengths)
+    run_bits = len(encoder.encode_header()) + np.cumsum(code_lengths) - code_lengths
+
+    alphabet = np.flatnonzero(np.bincount(encoder.bwt, minlength=256))
+    checkpoints = np.arange(0, len(run_chars), checkpoint_runs)
+    counts = np.empty((len(checkpoints), len(alphabet)), dtype=np.int64)
+    for column, char in enumerate(alphabet):
+        # number of times the character appears before the start of every run
+        seen = np.cumsum(np.where(run_chars == char, run_lengths, 0))
+        counts[:, column] = (seen - np.where(run_chars == char, run_lengths, 0))[checkpoints]
+    totals = np.bincount(encoder.bwt, minlength=256)[alphabet]
+
+    suffix_array = np.asarray(suffix_array)
+    sample_rows = np.flatnonzero(suffix_array % sa_sample == 0)
+    sample_positions = suffix_array[sample_rows]
+
+    # numbers are stored in 4 bytes unless the data is too long for it
+    width = 4 if len(suffix_array) < 2 ** 32 else 8
+    dtype = '>u%d' % width
+    parts = [
+        INDEX_HEADER.pack(len(alphabet), checkpoint_runs, sa_sample, len(checkpoints), len(sample_rows), width),
+        alphabet.astype(np.uint8).tobytes(),
+        totals.astype(dtype).tobytes(),
+        run_starts[checkpoints].astype(dtype).tobytes(),
+        # bit positions can pass 2 ** 32 before the row numbers do, so they always take 8 bytes
+        run_bits[checkpoints].astype('>u8').tobytes(),
+        counts.astype(dtype).tobytes(),
+        sample_rows.astype(dtype).tobytes(),
+        sample_positions.astype(dtype).tobytes(),
+    ]
+    return b''.join(parts)
+
+# Append the trailer to the index section, offset is the number of payload bytes before it
+def index_trailer(offset):
+    return INDEX_TRAILER.pack(offset, INDEX_MAGIC)
+
+# Query a file compressed with fm_index=True, file is its name or its bytes
+# only the header and the index section are read up front, the BWT is decoded a few runs at a time by the queries
+# RunLengthDecoder is only used for its header parsing and run decoding methods, nothing is decoded in full
+class FMIndex(RunLengthDecoder):
+    def __init__(self, file):
+        self.bit_string = self.file_to_bitarray(file)
+        self.length = len(self.bit_string)
+        self.reader = BitReader(memoryview(self.bit_string))
+        self.flags = self.decode_flags()
+        if not self.flags & FLAG_FM_INDEX:
+            raise ValueError("file has no FM-index")
+        if self.flags & FLAG_MTF:
+            raise ValueError("the FM-index does not support the move-to-front stage")
+        self.binary = bool(self.flags & FLAG_BYTES)
+        self.char_bits = 8 if self.binary else 7
+        self.decode_length()
+        self.binary_tree = BinaryTree()
+        self.huffman_codes = []
+        self.decode_header()
+        self.huffman_table = self.build_huffman_table()
+        self.read_index()
+        # checkpoint to the runs of its interval, least recently used first, see interval
+        self.intervals = OrderedDict()
+
+    # Read the index section through the trailer at the end of the file
+    def read_index(self):
+        data = memoryview(self.bit_string)
+        offset, magic = INDEX_TRAILER.unpack(data[len(data) - INDEX_TRAILER.size:])
+        if magic != INDEX_MAGIC:
+            raise ValueError("file has no FM-index")
+        alphabet_size, self.checkpoint_runs, self.sa_sample, checkpoint_count, sample_count, width = \
+            INDEX_HEADER.unpack(data[offset:offset + INDEX_HEADER.size])
+        offset += INDEX_HEADER.size
+        dtype = '>u%d' % width
+
+        # read the next count numbers of the given type, as native integers
+        def array(count, dtype=dtype):
+            nonlocal offset
+            size = count * np.dtype(dtype).itemsize
+            values = np.frombuffer(data[offset:offset + size], dtype=dtype).astype(np.int64)
+            offset += size
+            return values
+
+        alphabet = array(alphabet_size, np.uint8)
+        totals = array(alphabet_size)
+        self.checkpoint_rows = array(checkpoint_count)
+        self.checkpoint_bits = array(checkpoint_count, '>u8')
+        self.checkpoint_counts = array(checkpoint_count * alphabet_size).reshape(checkpoint_count, alphabet_size)
+        self.sample_rows = array(sample_count)
+        self.sample_positions = array(sample_count)
+        # the same figures as python lists and a dict, read once per LF step without going through numpy scalars
+        self.checkpoint_starts = self.checkpoint_rows.tolist()
+        self.checkpoint_table = self.checkpoint_counts.tolist()
+        self.samples = dict(zip(self.sample_rows.tolist(), self.sample_positions.tolist()))
+
+        # column of every character code in the checkpoint counts
+        self.columns = {int(char): column for column, char in enumerate(alphabet)}
+        # first row of every character in the first column, binary data has the virtual terminator in row 0
+        first = 1 if self.binary else 0
+        self.first_rows = {int(char): first + int(before) for char, before in zip(alphabet, np.cumsum(totals) - totals)}
+        # number of rows of the BWT matrix
+        self.rows = self.decoded_length + first
+        # row of the virtual terminator, its character is left out of the BWT
+        self.primary = self.primary_index if self.binary else None
+
+    # Decode the run whose code word starts at the given bit position, returns (character code, run length, next position)
+    def decode_run(self, pos):
+        reader = self.reader
+        reader.seek(pos)
+        if self.huffman_table is not None:
+            char, bits_used, run_length = self.huffman_table.lookup(reader)
+            reader.skip(bits_used)
+        else:
+            node = self.binary_tree.root
+            while not node.leaf:
+                node = self.binary_tree.get_next_node(node, reader.read(1))
+            char, run_length = node.char, 0
+        if run_length == 0:
+            run_length = reader.read_elias()
+        return ord(char), run_length, reader.pos
+
+    # Get the runs from the checkpoint up to the next one as (run starts, character codes, run lengths, number of times the
+    # character of every run appears in the interval before it)
+    # the intervals are decoded once and kept in an LRU cache of INTERVAL_CACHE_SIZE intervals
+    def interval(self, checkpoint):
+        runs = self.intervals.get(checkpoint)
+        if runs is not None:
+            self.intervals.move_to_end(checkpoint)
+            return runs
+        start = int(self.checkpoint_rows[checkpoint])
+        pos = int(self.checkpoint_bits[checkpoint])
+        end = int(self.checkpoint_rows[checkpoint + 1]) if checkpoint + 1 < len(self.checkpoint_rows) else self.decoded_length
+        runs = ([], [], [], [])
+        seen = {}
+        while start < end:
+            char, run_length, pos = self.decode_run(pos)
+            runs[0].append(start)
+            runs[1].append(char)
+            runs[2].append(run_length)
+            runs[3].append(seen.get(char, 0))
+            seen[char] = seen.get(char, 0) + run_length
+            start += run_length
+        self.intervals[checkpoint] = runs
+        if len(self.intervals) > INTERVAL_CACHE_SIZE:
+            self.intervals.popitem(last=False)
+        return runs
+
+    # Scan the BWT from the checkpoint before row (a row of the BWT without the virtual terminator) up to the row
+    # returns (checkpoint, counts of every character code between the checkpoint and the row, character at the row)
+    # the character is None when the row is past the last one
+    def scan(self, row):
+        checkpoint = bisect.bisect_right(self.checkpoint_starts, row) - 1
+        starts, chars, run_lengths, _ = self.interval(checkpoint)
+        # the run that holds the row, or the last run of the interval
+        run = bisect.bisect_right(starts, row) - 1
+        seen = {}
+        for char, run_length in zip(chars[:run], run_lengths[:run]):
+            seen[char] = seen.get(char, 0) + run_length
+        char = chars[run]
+        if row < starts[run] + run_lengths[run]:
+            seen[char] = seen.get(char, 0) + row - starts[run]
+            return checkpoint, seen, char
+        seen[char] = seen.get(char, 0) + run_lengths[run]
+        return checkpoint, seen, None
+
+    # Convert a row of the BWT matrix to the row of the BWT without the virtual terminator
+    def bwt_row(self, row):
+        if self.primary is not None and row > self.primary:
+            return row - 1
+        return row
+
+    # Number of times the character code appears in the rows of the BWT matrix before the given row
+    def occurrences(self, char, row):
+        checkpoint, seen, _ = self.scan(self.bwt_row(row))
+        return int(self.checkpoint_counts[checkpoint, self.columns[char]]) + seen.get(char, 0)
+
+    # LF-mapping of a row of the BWT matrix, the row of the suffix that starts one position earlier
+    def lf(self, row):
+        if row == self.primary:
+            return 0
+        row = self.bwt_row(row)
+        checkpoint = bisect.bisect_right(self.checkpoint_starts, row) - 1
+        starts, chars, _, before = self.interval(checkpoint)
+        run = bisect.bisect_right(starts, row) - 1
+        char = chars[run]
+        return (self.first_rows[char] + self.checkpoint_table[checkpoint][self.columns[char]] + before[run]
+                + row - starts[run])
+
+    # Convert the pattern to character codes, a string for text and bytes-like for binary data
+    def pattern_codes(self, pattern):
+        if isinstance(pattern, str):
+            return pattern.encode('latin-1')
+        return bytes(pattern)
+
+    # Range of rows of the BWT matrix whose suffixes start with the pattern, by backward search
+    def search(self, pattern):
+        start, end = 0, self.rows
+        for char in reversed(self.pattern_codes(pattern)):
+            if char not in self.columns:
+                return 0, 0
+            start = self.first_rows[char] + self.occurrences(char, start)
+            end = self.first_rows[char] + self.occurrences(char, end)
+            if start >= end:
+                return 0, 0
+        return start, end
+
+    # Number of times the pattern appears in the original data
+    def count(self, pattern):
+        start, end = self.search(pattern)
+        return end - start
+
+    # Sorted positions of every occurrence of the pattern in the original data
+    def locate(self, pattern):
+        start, end = self.search(pattern)
+        positions = []
+        for row in range(start, end):
+            steps = 0
+            # walk back until a sampled suffix, every step moves the suffix one position earlier
+            while True:
+                position = self.samples.get(row)
+                if position is not None:
+                    positions.append(position + steps)
+                    break
+                row = self.lf(row)
+                steps += 1
+        positions.sort()
+        return positions
@@ -3,87 +3,69 @@
 
 # This file contains the helper functions and class to build Suffix Tree using Ukkonen's algorithm used in q2_encoder.py, q2_decoder.py
 
-from bitarray import bitarray
-
-# convert char to ascii
-def char_to_ascii(char):
-    return ord(char) - 36
-
-# convert ascii to char
-def ascii_to_char(ascii):
-    return chr(ascii + 36)
-    
-# get bitarray of decimal number
-def decimal_to_binary(dec):
-    return bitarray(format(dec, 'b'))
-
-# get decimal from bitarray
-def binary_to_decimal(bit_array):
-    # convert bitarray to binary string
-    binary_string = bit_array.to01()
-    
-    # convert the binary string to a decimal integer
-    decimal_value = int(binary_string, 2)
-    
-    return decimal_value
-
-# convert char to bitarray
-def char_to_binary(char):
-    return bitarray('{0:07b}'.format(ord(char)))
+from instrument import stage
+
+# header flags, a header with flags starts with a 1 bit followed by the flags in 8 bits
+# the original header starts with the elias code of the length instead, whose first bit is 0 for every length above 1
+# a length of 1 has flags of 0 in front of it instead
+FLAG_MTF = 1
+# binary data over the full 0-255 alphabet, the BWT leaves out the terminator and the header stores its row
+FLAG_BYTES = 2
+# an FM-index section from fmindex.py follows the data part
+FLAG_FM_INDEX = 4
+# pipelines picked by the adaptive mode instead of the BWT: huffman code words of the input characters, or the input as it is
+FLAG_HUFFMAN = 8
+FLAG_STORED = 16
+# the huffman code words come from a pretrained dictionary from dictionary.py, the header stores its id instead of a table
+FLAG_DICTIONARY = 32
+# the runs are coded by the tANS backend of ans.py instead of huffman code words and elias run lengths
+FLAG_ANS = 64
 
 ### IMPLICIT SUFFIX TREE USING UKKONEN'S ALGORITHM ### (same code as in q1/q1.py)
-# Node class is mainly use to store list of Edge objects it has and suffix link, other attributes are used for easy recognition of the node
+# Node class is mainly use to store the Edge objects it has and suffix link
+# __slots__ keeps each node small, since a tree has up to 2n nodes
 class Node:
-    def __init__(self, from_edge, start_index):
-        # edge that lead to this node
-        self.from_edge = from_edge
-        # the smallest start index of the children edges
-        self.start_index = start_index
-        # list of Edge objects that the node has, only accept ascii character range of [36, 126]
-        self.children_edge = [None]*91
+    __slots__ = ('children_edge', 'suffix_link')
+
+    def __init__(self):
+        # sparse map from the first character of each children edge to the Edge object, so any alphabet can be used
+        self.children_edge = {}
         # suffix link of the node
         self.suffix_link = None
 
-# create a global endpointer variable
-endpointer = None
-
 # Edge class holds all the important information of an edge in the suffix tree
 class Edge:
-    def __init__(self, from_node, start, j, end=None):
-        # node that the edge is coming from
-        self.from_node = from_node
+    __slots__ = ('start', '_end', 'to_node', 'end_index')
+
+    def __init__(self, start, j, end=None):
         # TRICK 1: space-efficient representation of edge-labels/substrings
         # start index of the edge
         self.start = start
-        # end index of the edge. If not provided, this value will be retrieve from the global variable endpointer when called
+        # end index of the edge. If not provided, the edge is a leaf and its end is the endpointer of the tree that owns it
         self._end = end
         # node that the edge is going to, use this to do dfs traversal
         self.to_node = None
         # end index of the edge, use to construct suffix array
         self.end_index = j
-        
-    # TRICK 4: rapid leaf extension trick. Since a leaf is always a leaf, use global variable to keep track of the endpointer and only retrieve it when needed
-    # property to get the end index of the edge based on the global variable endpointer
-    @property
-    def end(self):
+
+    # TRICK 4: rapid leaf extension trick. Since a leaf is always a leaf, the tree keeps track of the endpointer and it is only retrieved when needed
+    # get the end index of the edge based on the endpointer of the tree
+    def get_end(self, endpointer):
         if self._end is None:
             return endpointer
         else:
             return self._end
 
-    # setter to set the end index of the edge based on the global variable endpointer
-    @end.setter
-    def end(self, value):
-        if self._end is None:
-            self._end = value
-
 # To construct the implicit suffix tree using Ukkonen's algorithm
+# All the construction state lives in the instance, so several trees can be built at the same time
 class SuffixTree:
     def __init__(self, string):
         self.string = string
         # initialise root node and set its suffix link
-        self.root = Node(None, -1)
+        self.root = Node()
         self.root.suffix_link = self.root
+        # end index shared by every leaf edge of this tree
+        self.endpointer = None
         # previous node to keep track of the new internal node created in the same phase
         self.prev_node = None
         # skipcountpointer to keep track of the successive characters along the edge
@@ -98,17 +80,19 @@ class SuffixTree:
         self.suffix_array = []
         
         # extend the suffix tree
-        self.extend()
+        with stage('suffix_tree.extend', len(string)):
+            self.extend()
 
         # do a dfs traversal to construct the suffix array
-        self.dfs(self.root)
+        with stage('suffix_tree.dfs', len(string)):
+            self.dfs(self.root)
 
     def extend(self):
+        string = self.string
         # Begin phase
-        for i in range(len(self.string)):
+        for i in range(len(string)):
             # RULE 1: Update endpointer in every phase for every leaves automatically
-            global endpointer
-            endpointer = i
+            self.endpointer = i
             # remaining suffix count to be added to the tree in the current phase
             self.remainder += 1
             
@@ -121,13 +105,13 @@ class SuffixTree:
                     self.active_edge = i
 
                 # find edge that starts with the current character
-                char_index = ord(self.string[self.active_edge]) - 36
-                edge = self.active_node.children_edge[char_index]
+                active_char = string[self.active_edge]
+                edge = self.active_node.children_edge.get(active_char)
 
                 # If edge already in the current node
                 if edge:
                     # Check the boundary of the edge
-                    boundary = edge.end - edge.start + 1
+                    boundary = edge.get_end(i) - edge.start + 1
                     
                     # If the remainder is within the boundary
                     if boundary > self.active_length:
@@ -138,7 +122,7 @@ class SuffixTree:
                         if self.prev_node is not None:
                             self.prev_node.suffix_link = self.active_node
                         # Rule 3: current character is already in the tree, do nothing
-                        if self.string[i] == self.string[self.skipcountpointer]:
+                        if string[i] == string[self.skipcountpointer]:
                             self.active_length += 1
                             # Current phase ends, set prev_node to None
                             self.prev_node = None
@@ -148,26 +132,25 @@ class SuffixTree:
                         # If the current character is not the same as the character along the edge
                         # RULE 2: Create new branch
                         # new internal node created
-                        new_node = Node(None, self.skipcountpointer)
+                        new_node = Node()
                         if self.prev_node is not None:
                             self.prev_node.suffix_link = new_node
                         # new internal edge created, which connects to the new node
-                        new_internal_edge = Edge(self.active_node, edge.start, None, self.skipcountpointer - 1)
+                        new_internal_edge = Edge(edge.start, None, self.skipcountpointer - 1)
                         new_internal_edge.to_node = new_node
                         # every nodes created has suffix link to the root
                         new_node.suffix_link = self.root
                         # new edge coming out from the new internal node
                         # the end index is set to i - self.remainder + 1, which means the index of the string this edge starts from
-                        new_branch_edge = Edge(new_node, i, i - self.remainder + 1)
-                        # remove the previous edge connected from the active node, add new internal edge as children edge
-                        self.active_node.children_edge[ord(self.string[edge.start]) - 36] = None
-                        self.active_node.children_edge[ord(self.string[new_internal_edge.start]) - 36] = new_internal_edge
+                        new_branch_edge = Edge(i, i - self.remainder + 1)
+                        # replace the previous edge connected from the active node with the new internal edge, both start with the same character
+                        self.active_node.children_edge[active_char] = new_internal_edge
                         # the start point of the previous edge is updated so that its start index continue from the new internal edge end point
                         # this approach remain it as a leaf (once a leaf, always a leaf), so the info of it as a leaf (particularly the end_index) is kept
                         edge.start = self.skipcountpointer
                         # the new node points to the previous edge (which start point is updated) and the new branch edge
-                        new_node.children_edge[ord(self.string[i]) - 36] = new_branch_edge
-                        new_node.children_edge[ord(self.string[edge.start]) - 36] = edge
+                        new_node.children_edge[string[i]] = new_branch_edge
+                        new_node.children_edge[string[edge.start]] = edge
                         # set new node to prev_node for suffix link creation in later extension
                         self.prev_node = new_node
                         # if active node is root, no suffix link to travel to, just update active edge and active length so it points to the next character
@@ -190,8 +173,8 @@ class SuffixTree:
                     if self.prev_node is not None:
                         self.prev_node.suffix_link = self.active_node
                     # Create a new edge from active node
-                    edge = Edge(self.active_node, i, i - self.remainder + 1)
-                    self.active_node.children_edge[char_index] = edge
+                    edge = Edge(i, i - self.remainder + 1)
+                    self.active_node.children_edge[active_char] = edge
                     self.prev_node = None
 
                 # update active point to the suffix link of the active node
@@ -204,11 +187,15 @@ class SuffixTree:
             self.prev_node = None
 
     # Traverse the suffix trie using DFS, to construct the suffix array in lexigraphical order
+    # an explicit stack of edges is used instead of recursion, so deep trees do not hit the recursion limit
     def dfs(self, n):
-        for i in range(91):
-            x = n.children_edge[i]
-            if x:
-                if x._end is None:  # means it is a leaf
-                    self.suffix_array.append(x.end_index)
-                else:
-                    self.dfs(x.to_node)
+        children = n.children_edge
+        # children are pushed in reverse order so the smallest character is popped first
+        stack = [children[char] for char in sorted(children, reverse=True)]
+        while stack:
+            x = stack.pop()
+            if x._end is None:  # means it is a leaf
+                self.suffix_array.append(x.end_index)
+            else:
+                children = x.to_node.children_edge
+                stack.extend([children[char] for char in sorted(children, reverse=True)])
@@ -0,0 +1,166 @@
+# This file contains the opt-in instrumentation of the encoder and decoder
+# Every stage of the pipeline runs inside stage(name), and when hooks are registered each stage reports an event to them:
+#   {'stage': name, 'seconds': wall time, 'input_size': ..., 'output_size': ..., 'peak_bytes': ..., 'estimate_bytes': ...}
+# sizes are None when a stage does not set them, and peak_bytes is None unless tracemalloc is tracing
+# estimate_bytes is the peak memory the stage expected to need, only the encode stage sets it
+# With no hooks, stage() returns a shared object that does nothing, so the cost is one function call per stage
+#
+# usage:
+#   metrics = Metrics()
+#   add_hook(metrics)
+#   RunLengthEncoder(string)
+#   metrics.snapshot()
+
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# registered hooks, replaced as a whole when changed so stages can iterate it without a lock
+hooks = ()
+hooks_lock = threading.Lock()
+# stages currently running on each thread, to carry the allocation peak of an inner stage to the outer one
+local = threading.local()
+
+# Register a callback that is called with the event of every stage
+def add_hook(hook):
+    global hooks
+    with hooks_lock:
+        hooks = hooks + (hook,)
+
+# Unregister a callback added with add_hook
+def remove_hook(hook):
+    global hooks
+    with hooks_lock:
+        hooks = tuple(h for h in hooks if h != hook)
+
+# Stage that does nothing, used when no hook is registered
+class NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    # sizes set on the null stage are dropped
+    def __setattr__(self, name, value):
+        pass
+
+NULL_STAGE = NullStage()
+
+# Stage that is timed and reported to the hooks, output_size and estimate_bytes can be set inside the with block
+class Stage:
+    def __init__(self, name, input_size):
+        self.name = name
+        self.input_size = input_size
+        self.output_size = None
+        self.estimate_bytes = None
+
+    def __enter__(self):
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            stack = local.__dict__.setdefault('stack', [])
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak is reset so it only covers this stage, the peak so far is kept for the outer stage
+            self.base = current
+            self.outer_peak = peak
+            self.inner_peak = 0
+            tracemalloc.reset_peak()
+            stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        peak_bytes = None
+        if self.tracing:
+            peak = max(tracemalloc.get_traced_memory()[1], self.inner_peak)
+            peak_bytes = peak - self.base
+            stack = local.stack
+            stack.pop()
+            if stack:
+                stack[-1].inner_peak = max(stack[-1].inner_peak, peak, self.outer_peak)
+        event = {
+            'stage': self.name,
+            'seconds': seconds,
+            'input_size': self.input_size,
+            'output_size': self.output_size,
+            'peak_bytes': peak_bytes,
+            'estimate_bytes': self.estimate_bytes,
+        }
+        for hook in hooks:
+            hook(event)
+        return False
+
+# Get the context manager of a stage, input_size is the size of what the stage works on
+def stage(name, input_size=None):
+    if not hooks:
+        return NULL_STAGE
+    return Stage(name, input_size)
+
+# Collect the events of every stage run inside the with block into a list, memory also traces the allocation peaks
+# used to carry the events of work done in another process back to the Metrics of the main process
+@contextmanager
+def collect(memory=False):
+    events = []
+    start_tracing = memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    add_hook(events.append)
+    try:
+        yield events
+    finally:
+        remove_hook(events.append)
+        if start_tracing:
+            tracemalloc.stop()
+
+# Hook that aggregates the events of every stage: count, total and largest time, total sizes, largest allocation peak
+# and largest memory estimate
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        self.record(event)
+
+    # Add an event to the figures of its stage
+    def record(self, event):
+        with self.lock:
+            figures = self.stages.get(event['stage'])
+            if figures is None:
+                figures = self.stages[event['stage']] = {
+                    'count': 0,
+                    'seconds_total': 0.0,
+                    'seconds_max': 0.0,
+                    'input_bytes_total': 0,
+                    'output_bytes_total': 0,
+                    'peak_bytes_max': 0,
+                    'estimate_bytes_max': 0,
+                }
+            figures['count'] += 1
+            figures['seconds_total'] += event['seconds']
+            figures['seconds_max'] = max(figures['seconds_max'], event['seconds'])
+            if event['input_size'] is not None:
+                figures['input_bytes_total'] += event['input_size']
+            if event['output_size'] is not None:
+                figures['output_bytes_total'] += event['output_size']
+            if event['peak_bytes'] is not None:
+                figures['peak_bytes_max'] = max(figures['peak_bytes_max'], event['peak_bytes'])
+            if event['estimate_bytes'] is not None:
+                figures['estimate_bytes_max'] = max(figures['estimate_bytes_max'], event['estimate_bytes'])
+
+    # Copy of the figures of every stage, with the mean time
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for name, figures in self.stages.items():
+                result[name] = dict(figures, seconds_mean=figures['seconds_total'] / figures['count'])
+            return result
+
+    # Forget every figure
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
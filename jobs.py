@@ -0,0 +1,221 @@
+# This file contains the asynchronous job queue used by app.py for uploads too slow to handle inside one request
+# A job is submitted with the function that does its work, and gets an id that its status, progress and result are read by
+# The work runs on one of the runner threads of the queue, and hands the heavy parts to the backend with map(), which spreads
+# them over the backend and reports progress as their results come back. The backend is any concurrent.futures executor:
+# a ProcessPoolExecutor in the app, or a ThreadPoolExecutor so everything stays in one process, e.g. in tests
+# At most max_jobs jobs are queued or running at once, later submissions are turned away until one finishes
+# Finished jobs, and their results, are forgotten ttl seconds after they finish
+#
+# usage:
+#   jobs = JobQueue(ThreadPoolExecutor(2), max_jobs=8, ttl=3600)
+#   job = jobs.submit('encode', data, lambda job, data: b''.join(jobs.map(job, compress, [data])))
+#   jobs.get(job.id).info()
+#   jobs.result(job.id)
+
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+
+# states of a job, the last three are final
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Raised inside the work of a job once it is cancelled, so the work stops at the next map() result
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, action, size):
+        self.id = uuid.uuid4().hex
+        self.action = action
+        self.size = size
+        self.status = QUEUED
+        # fraction of the work done, from 0 to 1
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.cancel_event = threading.Event()
+
+    # Whether the job reached a final state
+    def done(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    # Description of the job, without its result
+    def info(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'status': self.status,
+            'progress': self.progress,
+            'input_size': self.size,
+            'result_size': None if self.result is None else len(self.result),
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+# backend is a concurrent.futures executor, or a function returning one so a pool is only started by the first job
+# runners is the number of jobs worked on at once
+class JobQueue:
+    def __init__(self, backend, runners=1, max_jobs=16, ttl=3600):
+        self.backend = backend
+        self.runners = runners
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        # id to job, for every job that has not expired
+        self.jobs = {}
+        # jobs waiting for a runner, with their data and work
+        self.waiting = queue.Queue()
+        # number of jobs queued or running
+        self.active = 0
+        self.threads = []
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    # Get the executor of the backend
+    def executor(self):
+        with self.lock:
+            if not hasattr(self.backend, 'submit'):
+                self.backend = self.backend()
+            return self.backend
+
+    # Queue a job, work(job, data) is called on a runner thread and returns the result as bytes
+    # returns the job, or None when max_jobs jobs are already queued or running
+    def submit(self, action, data, work):
+        self.expire()
+        with self.lock:
+            if self.active >= self.max_jobs:
+                self.rejected += 1
+                return None
+            self.active += 1
+            job = Job(action, len(data))
+            self.jobs[job.id] = job
+            # runners are only started by the first job
+            while len(self.threads) < self.runners:
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        self.waiting.put((job, data, work))
+        return job
+
+    # Loop of a runner thread, works on the waiting jobs one after the other
+    def run(self):
+        while True:
+            job, data, work = self.waiting.get()
+            # the data is only kept until the job runs
+            self.work(job, data, work)
+            del data
+            with self.lock:
+                self.active -= 1
+
+    # Run the work of the job and record how it ended
+    # a job cancelled before it starts or while it runs ends as CANCELLED, whichever check sees the cancel first
+    def work(self, job, data, work):
+        with self.lock:
+            cancelled = job.done() or job.cancel_event.is_set()
+            if not cancelled:
+                job.status = RUNNING
+        if cancelled:
+            self.finish(job, CANCELLED)
+            return
+        try:
+            result = work(job, data)
+        except JobCancelled:
+            self.finish(job, CANCELLED)
+            return
+        except Exception as error:
+            job.error = '%s: %s' % (type(error).__name__, error)
+            self.finish(job, FAILED)
+            return
+        if job.cancel_event.is_set():
+            self.finish(job, CANCELLED)
+            return
+        job.result = bytes(result)
+        job.progress = 1.0
+        self.finish(job, DONE)
+
+    # Set the final state of the job
+    def finish(self, job, status):
+        with self.lock:
+            if job.done():
+                return
+            job.status = status
+            job.finished = time.time()
+
+    # Apply func to every item on the backend and yield the results in the same order as the items
+    # at most 2 items per runner are in flight, the progress of the job follows the results, and JobCancelled is raised
+    # as soon as the job is cancelled, after cancelling the items that did not start yet
+    def map(self, job, func, items):
+        items = list(items)
+        executor = self.executor()
+        pending = deque()
+        remaining = iter(items)
+        completed = 0
+        try:
+            while True:
+                while len(pending) < 2 * self.runners:
+                    item = next(remaining, None)
+                    if item is None:
+                        break
+                    pending.append(executor.submit(func, item))
+                if not pending:
+                    return
+                result = pending.popleft().result()
+                if job.cancel_event.is_set():
+                    raise JobCancelled()
+                completed += 1
+                job.progress = completed / len(items)
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    # Get the job of the id, or None when there is no such job or it expired
+    def get(self, job_id):
+        self.expire()
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    # Get the result of the job of the id, or None when there is no such job or it is not done
+    def result(self, job_id):
+        job = self.get(job_id)
+        if job is None or job.status != DONE:
+            return None
+        return job.result
+
+    # Cancel the job of the id, a queued job never runs and a running one stops at its next result
+    # returns the job, or None when there is no such job
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        self.finish(job, CANCELLED)
+        return job
+
+    # Forget the jobs that finished more than ttl seconds ago
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for job_id in [job.id for job in self.jobs.values() if job.done() and now - job.finished > self.ttl]:
+                del self.jobs[job_id]
+
+    # Counters of the queue
+    def stats(self):
+        with self.lock:
+            statuses = {}
+            for job in self.jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {
+                'active': self.active,
+                'max_jobs': self.max_jobs,
+                'rejected': self.rejected,
+                'jobs': statuses,
+            }
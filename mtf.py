@@ -0,0 +1,70 @@
+# This file contains the move-to-front transform and the bzip2-style zero-run coding used between the BWT and huffman coding
+# After the BWT equal characters are grouped in runs, so the transform works on whole runs instead of single characters:
+# the first character of a run gets its move-to-front index and the rest of the run are zeros
+# Runs of zeros are written in bijective base 2 with the digits RUNA (1) and RUNB (2), and every other index i is written as the symbol i + 1
+
+import numpy as np
+
+RUNA = 0
+RUNB = 1
+
+# Get the move-to-front index of the character of every run, the list of characters starts as the given sorted alphabet
+def mtf_encode(run_chars, alphabet):
+    order = list(alphabet)
+    indices = []
+    for char in run_chars:
+        index = order.index(char)
+        if index:
+            order.insert(0, order.pop(index))
+        indices.append(index)
+    return indices
+
+# Append the RUNA/RUNB digits of a run of zeros to the symbols, least significant digit first
+def append_zero_run(symbols, length):
+    while length > 0:
+        if length & 1:
+            symbols.append(RUNA)
+            length = (length - 1) >> 1
+        else:
+            symbols.append(RUNB)
+            length = (length - 2) >> 1
+
+# Convert the runs of the BWT (character, run length) to the array of symbols
+def encode_runs(run_chars, run_lengths, alphabet):
+    symbols = []
+    # zeros waiting to be written, they are only written once a non-zero index ends them
+    zeros = 0
+    for index, length in zip(mtf_encode(run_chars, alphabet), run_lengths):
+        if index:
+            append_zero_run(symbols, zeros)
+            symbols.append(index + 1)
+            zeros = length - 1
+        else:
+            # only the first run can have index 0, since two runs in a row never share a character
+            zeros += length
+    append_zero_run(symbols, zeros)
+    return np.array(symbols, dtype=np.int64)
+
+# Convert the symbols back to the BWT string, the alphabet is the list of characters in the same order given to encode_runs
+def decode_runs(symbols, alphabet):
+    order = list(alphabet)
+    pieces = []
+    zeros = 0
+    # weight of the next RUNA/RUNB digit
+    weight = 1
+    for symbol in symbols:
+        if symbol <= RUNB:
+            zeros += (symbol + 1) * weight
+            weight <<= 1
+            continue
+        # a run of zeros repeats the character at the front of the list
+        if zeros:
+            pieces.append(order[0] * zeros)
+            zeros = 0
+            weight = 1
+        char = order.pop(symbol - 1)
+        order.insert(0, char)
+        pieces.append(char)
+    if zeros:
+        pieces.append(order[0] * zeros)
+    return "".join(pieces)
@@ -0,0 +1,206 @@
+# This file contains the suffix array construction engines used by BWTConverter in encoder.py
+# Every engine expects text input to end with a unique terminator that is smaller than every other character ('$'),
+# bytes-like input can hold any byte value and gets a virtual terminator appended after its last byte instead,
+# so its suffix array has one more entry than the input. All engines return the same suffix array (as a list, or a numpy array for doubling), so the BWT built from them is identical
+
+import numpy as np
+from helper import SuffixTree
+
+# convert the input string to a list of dense ranks, where the terminator is ranked 0
+def dense_ranks(string):
+    alphabet = sorted(set(string))
+    ranks = {char: rank for rank, char in enumerate(alphabet)}
+    codes = [ranks[char] for char in string]
+    if codes[-1] != 0 or codes.count(0) != 1:
+        raise ValueError("input must end with a unique terminator smaller than every other character")
+    return codes, len(alphabet)
+
+# convert the input to a numpy array of integer codes ending with the unique terminator 0, and the size of the alphabet
+# the bytes of bytes-like input are ranked from 1 in order of value, leaving 0 for the virtual terminator
+def dense_codes(string):
+    if isinstance(string, str):
+        codes, alphabet_size = dense_ranks(string)
+        return np.array(codes, dtype=np.int64), alphabet_size
+    data = np.frombuffer(string, dtype=np.uint8)
+    # rank of every byte value among the byte values present
+    ranks = np.cumsum(np.bincount(data, minlength=256) > 0)
+    codes = np.zeros(len(data) + 1, dtype=np.int64)
+    codes[:-1] = ranks[data]
+    return codes, int(ranks[-1]) + 1
+
+# Build the suffix array with the Ukkonen suffix tree from helper.py
+def tree_suffix_array(string):
+    if not isinstance(string, str):
+        string = dense_codes(string)[0].tolist()
+    return SuffixTree(string).suffix_array
+
+# Build the suffix array with SA-IS (induced sorting), linear time in pure python
+def sais_suffix_array(string):
+    if isinstance(string, str):
+        codes, alphabet_size = dense_ranks(string)
+    else:
+        codes, alphabet_size = dense_codes(string)
+        codes = codes.tolist()
+    return sais(codes, alphabet_size)
+
+# SA-IS on a list of integer codes in range [0, alphabet_size), the last code must be the unique 0
+def sais(s, alphabet_size):
+    n = len(s)
+    if n == 1:
+        return [0]
+
+    # classify every suffix as S-type (True) or L-type (False)
+    stype = [False] * n
+    stype[-1] = True
+    for i in range(n - 2, -1, -1):
+        stype[i] = s[i] < s[i + 1] or (s[i] == s[i + 1] and stype[i + 1])
+
+    # leftmost S-type positions, in text order
+    lms = [i for i in range(1, n) if stype[i] and not stype[i - 1]]
+    is_lms = [False] * n
+    for i in lms:
+        is_lms[i] = True
+
+    # size of the bucket of each character
+    counts = [0] * alphabet_size
+    for c in s:
+        counts[c] += 1
+
+    # head and tail index of each bucket
+    def bucket_heads():
+        heads = [0] * alphabet_size
+        total = 0
+        for c in range(alphabet_size):
+            heads[c] = total
+            total += counts[c]
+        return heads
+
+    def bucket_tails():
+        tails = [0] * alphabet_size
+        total = 0
+        for c in range(alphabet_size):
+            total += counts[c]
+            tails[c] = total - 1
+        return tails
+
+    # place the given LMS positions at the end of their buckets, then induce the L-type and S-type suffixes
+    def induce(lms_positions):
+        sa = [-1] * n
+        tails = bucket_tails()
+        for p in reversed(lms_positions):
+            c = s[p]
+            sa[tails[c]] = p
+            tails[c] -= 1
+
+        heads = bucket_heads()
+        for i in range(n):
+            j = sa[i] - 1
+            if j >= 0 and not stype[j]:
+                c = s[j]
+                sa[heads[c]] = j
+                heads[c] += 1
+
+        tails = bucket_tails()
+        for i in range(n - 1, -1, -1):
+            j = sa[i] - 1
+            if j >= 0 and stype[j]:
+                c = s[j]
+                sa[tails[c]] = j
+                tails[c] -= 1
+        return sa
+
+    # compare two LMS substrings, the terminator is only equal to itself
+    def lms_equal(a, b):
+        if a == n - 1 or b == n - 1:
+            return a == b
+        i = 0
+        while True:
+            a_end = i > 0 and is_lms[a + i]
+            b_end = i > 0 and is_lms[b + i]
+            if a_end and b_end:
+                return True
+            if a_end != b_end or s[a + i] != s[b + i] or stype[a + i] != stype[b + i]:
+                return False
+            i += 1
+
+    # sort the LMS substrings by inducing from an arbitrary LMS order
+    sa = induce(lms)
+
+    # name each LMS substring by its rank among the sorted LMS substrings
+    names = [-1] * n
+    name = -1
+    prev = -1
+    for p in sa:
+        if is_lms[p]:
+            if prev == -1 or not lms_equal(prev, p):
+                name += 1
+            names[p] = name
+            prev = p
+
+    # the reduced string keeps the text order of the LMS positions, its last name is the terminator's 0
+    reduced = [names[p] for p in lms]
+    if name + 1 == len(reduced):
+        # all names are unique, so the reduced suffix array is the inverse of the reduced string
+        reduced_sa = [0] * len(reduced)
+        for i, r in enumerate(reduced):
+            reduced_sa[r] = i
+    else:
+        reduced_sa = sais(reduced, name + 1)
+
+    # induce the final suffix array from the correctly sorted LMS suffixes
+    return induce([lms[i] for i in reduced_sa])
+
+# Build the suffix array with numpy prefix doubling, each round sorts the suffixes by their first 2k characters
+def doubling_suffix_array(string):
+    rank, _ = dense_codes(string)
+    n = len(rank)
+    sa = np.argsort(rank, kind='stable')
+    k = 1
+    while k < n:
+        # rank of the suffix k characters ahead, 0 when it runs past the end of the string
+        second = np.zeros(n, dtype=np.int64)
+        second[:n - k] = rank[k:] + 1
+        key = rank * (n + 1) + second
+        sa = np.argsort(key, kind='stable')
+        sorted_key = key[sa]
+        # suffixes with the same key share the same new rank
+        new_rank = np.empty(n, dtype=np.int64)
+        new_rank[0] = 0
+        np.cumsum(sorted_key[1:] != sorted_key[:-1], out=new_rank[1:])
+        rank[sa] = new_rank
+        # stop once every suffix has a distinct rank
+        if new_rank[-1] == n - 1:
+            break
+        k *= 2
+    return sa
+
+ENGINES = {
+    'tree': tree_suffix_array,
+    'sais': sais_suffix_array,
+    'doubling': doubling_suffix_array,
+}
+
+# peak bytes each engine allocates per input character, measured with tracemalloc and rounded up for some headroom
+# the suffix tree varies the most with the input, since it takes a node and an edge per branch
+ENGINE_MEMORY = {
+    'tree': 640,
+    'sais': 200,
+    'doubling': 72,
+}
+
+# Get the engine the method names, 'auto' uses numpy prefix doubling, which is the fastest engine from a few characters
+# up to multi-megabyte inputs and also the one that needs the least memory
+def resolve_method(method):
+    if method == 'auto':
+        method = 'doubling'
+    if method not in ENGINES:
+        raise ValueError("unknown suffix array method: %r" % (method,))
+    return method
+
+# Estimate the peak memory in bytes the engine allocates for an input of the given length
+def engine_memory(length, method='auto'):
+    return ENGINE_MEMORY[resolve_method(method)] * (length + 1)
+
+# Build the suffix array of the given string with the chosen engine
+def build_suffix_array(string, method='auto'):
+    return ENGINES[resolve_method(method)](string)
@@ -0,0 +1,33 @@
+# Tests of the block container of blocks.py
+
+import io
+import pytest
+from blocks import compress_stream, append_stream, decompress_stream, decode_range
+
+# Get the bytes of a container of the text or bytes
+def container_of(data, **options):
+    fileobj = io.StringIO(data) if isinstance(data, str) else io.BytesIO(data)
+    return b''.join(compress_stream(fileobj, **options))
+
+# Decode every block of the container bytes
+def decode_all(data):
+    blocks = list(decompress_stream(io.BytesIO(data)))
+    return blocks[0][:0].join(blocks)
+
+# An append that fails in a later block must leave the container as it was
+@pytest.mark.parametrize('dedup', [False, True])
+def test_failed_append_keeps_container(dedup):
+    original = container_of('ABRACADABRA' * 100, block_size=256, dedup=dedup)
+    container = io.BytesIO(original)
+    with pytest.raises(ValueError):
+        append_stream(container, io.StringIO('BANANA' * 100 + 'not text'), block_size=256, dedup=dedup)
+    assert container.getvalue() == original
+    assert decode_all(container.getvalue()) == 'ABRACADABRA' * 100
+    assert decode_range(container, 500, 520) == ('ABRACADABRA' * 100)[500:520]
+
+# Appending to a plain container with dedup marks it as a dedup container and keeps both parts
+def test_append_dedup():
+    container = io.BytesIO(container_of(b'first part ' * 50, block_size=128))
+    append_stream(container, io.BytesIO(b'second part ' * 50), block_size=128, dedup=True)
+    assert container.getvalue().startswith(b'BWTR')
+    assert decode_all(container.getvalue()) == b'first part ' * 50 + b'second part ' * 50